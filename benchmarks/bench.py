@@ -0,0 +1,302 @@
+"""Offline benchmarks of the oceandata parsers, loaders and caches
+
+Synthetic inputs are generated at several scales in the formats of the
+real datasets: GDP .dat.gz seeded from data/buoydata_sample.dat.gz,
+PANGAEA .tab files with /* */ headers, the Mattei txt layout, HOT .pp
+files and the MAPPS PML csv seeded from data/GLOBAL_PE_W_LOV_2019.csv.
+One scale unit is UNITROWS rows.
+
+Every dataset is timed in three phases, each in a fresh interpreter so
+the peak resident memory belongs to that phase alone:
+
+    cold   parse the raw file(s) and write the parquet cache
+    warm   load the dataframe from the cache
+    query  load a bbox, time or depth subset from the cache
+
+Each interpreter uses a store root of its own in the work directory, so
+nothing is read from or written to ~/.oceandata, and the cold phase
+starts from an empty store. Every phase is run REPEATS times and the
+fastest run is kept. Import time is not included.
+
+Results are compared with the stored baseline and phases slower than
+TOLERANCE times the baseline are reported as regressions, unless both
+take less than MINTIME seconds. Likewise phases whose peak memory grows
+by more than TOLERANCE times the growth in the baseline are regressions,
+unless both grow by less than MINRSS MB. Timings depend on the machine,
+so save a new baseline before comparing on a new one.
+
+Usage:
+    python benchmarks/bench.py
+    python benchmarks/bench.py --scales 1 10 --datasets gdp hot
+    python benchmarks/bench.py --save
+
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLEDIR = os.path.join(ROOTDIR, "data")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")
+UNITROWS = 10_000
+SCALES = [1, 10]
+PHASES = ["cold", "warm", "query"]
+TOLERANCE = 1.25
+REPEATS = 3
+MINTIME = 0.2
+MINRSS = 32
+
+
+def write_gdp(directory, nrows):
+    """Replicate the GDP sample with new drifter ids"""
+    with gzip.open(os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz")) as fH:
+        lines = fH.read().splitlines()
+    rows = [line.split(maxsplit=1) for line in lines]
+    filename = os.path.join(directory, "buoydata.dat.gz")
+    with gzip.open(filename, "wb", compresslevel=1) as fH:
+        for copy in range(-(-nrows // len(rows))):
+            block = [b"%8d %s" % (int(id) + 100_000 * copy, rest)
+                     for id, rest in rows]
+            fH.write(b"\n".join(block) + b"\n")
+    return [filename]
+
+
+def write_pangaea(directory, nrows):
+    """Write a Valente-like PANGAEA tab file"""
+    columns = ["Event", "Date/Time", "Latitude", "Longitude",
+               "Chl a [mg/m**3] (High Performance Liquid Chrom...)",
+               "Chl a [mg/m**3] (Chlorophyll a, fluorometric o...)"]
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        columns[0]: np.char.add("ev", (np.arange(nrows) % 50).astype(str)),
+        columns[1]: (pd.Timestamp("1997-01-01") + pd.to_timedelta(
+            np.arange(nrows) * 6, unit="h")).strftime("%Y-%m-%dT%H:%M"),
+        columns[2]: rng.uniform(-80, 80, nrows).round(4),
+        columns[3]: rng.uniform(-180, 180, nrows).round(4),
+        columns[4]: rng.lognormal(0, 1, nrows).round(3),
+        columns[5]: rng.lognormal(0, 1, nrows).round(3)})
+    df.loc[df.index % 3 == 0, columns[5]] = np.nan
+    filename = os.path.join(directory, "insitudb_chla_V3.tab")
+    with open(filename, "w") as fH:
+        fH.write("/* DATA DESCRIPTION:\n")
+        fH.write("Citation:\tValente, A et al. (2022): In situ chlorophyll. "
+                 "PANGAEA, https://doi.org/10.1594/PANGAEA.941318\n")
+        fH.write("Parameter(s):\tDate/Time (Date/Time) * GEOCODE\n")
+        fH.write("\tLatitude (Latitude) * GEOCODE\n")
+        fH.write("*/\n")
+        df.to_csv(fH, sep="\t", index=False)
+    return [filename]
+
+
+def write_mattei(directory, nrows):
+    """Write a file in the Mattei txt layout"""
+    names = (["Date", "Latitude", "Longitude", "Year", "Month",
+              "Day of the year", "Bottom depth (m)", "Bottom depth sd (m)",
+              "Northern hemisphere season", "PAR_flag", "SST_flag",
+              "hemisphere", "SST (°C)", "SST magnitude",
+              "Depth-integrated primary production (mg C m^-2 day^-1)"] +
+             [f"var{i}" for i in range(28)])
+    rng = np.random.default_rng(0)
+    dates = pd.Timestamp("1990-01-01") + pd.to_timedelta(
+        np.arange(nrows) % 10_000, unit="D")
+    df = pd.DataFrame({"ID":np.arange(nrows), "Source":"src", "Cruise":"cr",
+                       "Date":dates.strftime("%d/%m/%Y"),
+                       "Latitude":rng.uniform(-80, 80, nrows).round(3),
+                       "Longitude":rng.uniform(-180, 180, nrows).round(3),
+                       "Year":dates.year, "Month":dates.month,
+                       "Day of the year":dates.dayofyear})
+    values = rng.uniform(0, 100, (nrows, len(names) - 6)).round(2)
+    df = pd.concat([df, pd.DataFrame(values, columns=names[6:])], axis=1)
+    filename = os.path.join(directory, "mattei.txt")
+    with open(filename, "w") as fH:
+        fH.write("Global marine phytoplankton production dataset\n\n")
+        df.to_csv(fH, sep="\t", index=False)
+    return [filename]
+
+
+def write_hot(directory, nrows, cruiserows=24):
+    """Write one HOT pp file per cruise"""
+    filenames = []
+    for cruise in range(1, max(1, nrows // cruiserows) + 1):
+        date = pd.Timestamp("1989-01-01") + pd.Timedelta(
+            days=7 * (cruise % 3000))
+        filename = os.path.join(directory, f"hot{cruise}.pp")
+        with open(filename, "w") as fH:
+            for line in range(7):
+                fH.write(f"HOT primary production header line {line}\n")
+            for row in range(cruiserows):
+                values = ([cruise, row % 2, 1200, f"{date:%y%m%d}", 600, 1800,
+                           5 * row, 0.1, 0.01, 0.05, 0.01] +
+                          [3.0 + row, 3.2 + row, -9, 0.1, 0.2, 0.1] +
+                          [35.1, 100, 200, 300, 40, 0])
+                fH.write(" ".join(str(v) for v in values) + "\n")
+        filenames.append(filename)
+    return filenames
+
+
+def write_mapps(directory, nrows):
+    """Replicate the MAPPS PML csv"""
+    df = pd.read_csv(os.path.join(SAMPLEDIR, "GLOBAL_PE_W_LOV_2019.csv"))
+    df = pd.concat([df] * -(-nrows // len(df)), ignore_index=True)
+    filename = os.path.join(directory, "GLOBAL_PE_W_LOV_2019.csv")
+    df.iloc[:nrows].to_csv(filename, index=False)
+    return [filename]
+
+
+def datasets():
+    """Return writer, reader, reader kwargs and query filters by name"""
+    from oceandata import gdp, mapps
+    from oceandata.chl import valente
+    from oceandata.primary_production import hot, mattei
+    return {
+        "gdp":(write_gdp, gdp.read_dat, gdp.ALLCOLUMNS,
+               dict(bbox=(130, 30, 140, 40), start="2010-11-01")),
+        "pangaea":(write_pangaea, valente.read_tab, {},
+                   dict(bbox=(-60, 0, 0, 60), start="2000-01-01")),
+        "mattei":(write_mattei, mattei.read_txt, {},
+                  dict(bbox=(-60, 0, 0, 60), end="2000-01-01")),
+        "hot":(write_hot, hot.read_pp_files, {},
+               dict(start="1995-01-01", depth=50)),
+        "mapps":(write_mapps, mapps.read_pml, {},
+                 dict(bbox=(-80, 0, 20, 60), depth=(0, 50))),
+    }
+
+
+def peak_rss_mb():
+    """Return peak resident memory of this process in MB"""
+    try:
+        with open("/proc/self/status") as fH:
+            for line in fH:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 1024
+
+
+def run_phase(name, phase, sources, rootdir, queue):
+    """Time one phase of a dataset in a private store, report through queue"""
+    if phase == "cold":
+        shutil.rmtree(rootdir, ignore_errors=True)
+    os.environ["OCEANDATA_DIR"] = rootdir
+    import pyarrow.parquet  # keep the import out of the timings
+    from oceandata import cache, filters, store
+    store.set_root(rootdir)
+    _, reader, kwargs, query = datasets()[name]
+    dnf = filters.build(**query) if phase == "query" else None
+    rss0 = peak_rss_mb()
+    t0 = time.perf_counter()
+    df = cache.cached(f"bench_{name}", sources, reader, kwargs=kwargs,
+                      filters=dnf)
+    wall = time.perf_counter() - t0
+    rss = peak_rss_mb()
+    queue.put({"time":wall, "rows":len(df),
+               "rows_per_s":len(df) / wall if wall else float("inf"),
+               "rss_mb":rss, "rss_delta_mb":rss - rss0})
+
+
+def run(names=None, scales=SCALES, workdir=None, repeats=REPEATS):
+    """Run all phases of the given datasets and scales, return results
+
+    Every phase is run repeats times, the fastest run is returned.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    names = list(datasets()) if names is None else names
+    results = {}
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdirname:
+        for name in names:
+            for scale in scales:
+                directory = os.path.join(tmpdirname, f"{name}_{scale}")
+                os.makedirs(directory)
+                sources = datasets()[name][0](directory, scale * UNITROWS)
+                for phase in PHASES:
+                    runs = []
+                    for _ in range(repeats):
+                        queue = ctx.Queue()
+                        proc = ctx.Process(target=run_phase, args=(
+                            name, phase, sources,
+                            os.path.join(directory, "store"), queue))
+                        proc.start()
+                        runs.append(queue.get())
+                        proc.join()
+                    result = min(runs, key=lambda run: run["time"])
+                    results[f"{name}/{scale}/{phase}"] = result
+                    print(f"{name:8s} {scale:4d} {phase:6s} "
+                          f"{result['time']:8.3f} s "
+                          f"{result['rows_per_s']:12,.0f} rows/s "
+                          f"{result['rss_mb']:8.1f} MB "
+                          f"(+{result['rss_delta_mb']:.1f})", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE, mintime=MINTIME,
+            minrss=MINRSS):
+    """Return keys of phases slower or larger than tolerance times baseline
+
+    Time is compared unless the phase takes less than mintime seconds in
+    both runs, and the peak memory growth of the phase unless it is below
+    minrss MB in both runs.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        ratio = result["time"] / base["time"]
+        rss = result["rss_delta_mb"] / max(base["rss_delta_mb"], 1e-3)
+        flags = []
+        if ratio > tolerance and max(result["time"], base["time"]) >= mintime:
+            flags.append("TIME")
+        if rss > tolerance and max(result["rss_delta_mb"],
+                                   base["rss_delta_mb"]) >= minrss:
+            flags.append("RSS")
+        if flags:
+            regressions.append(key)
+        flag = f"  {' '.join(flags)} REGRESSION" if flags else ""
+        print(f"{key:24s} time x{ratio:5.2f}  rss x{rss:5.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--datasets", nargs="+", choices=list(datasets()))
+    parser.add_argument("--scales", nargs="+", type=int, default=SCALES)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--mintime", type=float, default=MINTIME,
+                        help="Do not flag phases faster than this (s)")
+    parser.add_argument("--minrss", type=float, default=MINRSS,
+                        help="Do not flag phases growing less than this (MB)")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--workdir", help="Directory for synthetic inputs")
+    parser.add_argument("--save", action="store_true",
+                        help="Store the results as the new baseline")
+    args = parser.parse_args()
+    results = run(args.datasets, args.scales, args.workdir, args.repeats)
+    if args.save:
+        with open(args.baseline, "w") as fH:
+            json.dump(results, fH, indent=1, sort_keys=True)
+        return 0
+    if not os.path.isfile(args.baseline):
+        print(f"No baseline in {args.baseline}, run with --save")
+        return 0
+    with open(args.baseline) as fH:
+        baseline = json.load(fH)
+    return 1 if compare(results, baseline, args.tolerance,
+                        args.mintime, args.minrss) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
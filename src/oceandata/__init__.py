@@ -2,8 +2,27 @@ __version__ = '0.3.1'
 
 __all__ = ["chl", "primary_production", "rrs"]
 
-from .oscillations import read_enso as enso
+import importlib
 
-from . import rrs
+_submodules = {"bundle":".bundle", "cache":".cache", "chl":".chl",
+               "cli":".cli", "downloader":".downloader",
+               "export_production":".export_production",
+               "filters":".filters", "gdp":".gdp",
+               "instrument":".instrument",
+               "mapps":".mapps", "matchup":".matchup",
+               "oscillations":".oscillations", "pangaea":".pangaea",
+               "primary_production":".primary_production", "rrs":".rrs",
+               "seabass_pic":".seabass_pic", "store":".store",
+               "valente":".rrs.valente"}
 
-from .rrs import valente
+def __getattr__(name):
+    """Import submodules on first access (PEP 562)"""
+    if name == "enso":
+        from .oscillations import read_enso
+        return read_enso
+    if name in _submodules:
+        return importlib.import_module(_submodules[name], __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules) | {"enso"})
@@ -0,0 +1,245 @@
+"""Portable bundles of pre-parsed datasets
+
+A bundle is one uncompressed tar archive holding the cleaned dataframe of
+every dataset as a parquet file together with a json manifest. The
+manifest is the first member and records the bundle format, the oceandata
+version and creation time, and the file, sha256, size, rows and columns
+of each dataset.
+
+Loaders serve a dataset from the active bundle before they look for raw
+files, so nodes without internet need neither downloads nor parsing. The
+active bundle is ROOT/bundle, where `install` unpacks an archive, or the
+directory or archive set with store.set_bundle() or OCEANDATA_BUNDLE.
+Archives are read in place through a memory map, so a read-only copy on
+a shared file system works as well.
+
+Example:
+    bundle.export("oceandata.tar")
+    bundle.install("oceandata.tar")
+    df = mapps.load()
+
+or from the shell:
+    oceandata bundle export oceandata.tar
+    oceandata bundle import oceandata.tar
+
+"""
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import warnings
+import functools
+
+from . import __version__, cache, filters as rowfilters, instrument, store
+
+FORMAT = 1
+MANIFEST = "manifest.json"
+BLOCKSIZE = 1 << 20
+
+_memo = {}
+
+
+def datasets():
+    """Return the loader of every dataset that can be bundled, by name"""
+    from . import gdp, mapps, oscillations
+    from .chl import valente as chl_valente
+    from .rrs import valente as rrs_valente
+    from .primary_production import buitenhuis, hot, mattei
+    from .export_production import mouw
+    loaders = {"mapps":mapps.load, "mapps_pml":mapps.load_pml,
+               "valente_chl":chl_valente.load, "valente_rrs":rrs_valente.load,
+               "mattei":mattei.load, "buitenhuis":buitenhuis.load,
+               "mouw":mouw.load,
+               "mouw_std":functools.partial(mouw.load, with_std=True),
+               "hot":hot.load}
+    for v1 in gdp.SEGMENTS:
+        loaders[f"buoydata_{v1}"] = functools.partial(
+            gdp.load, v1, columns=gdp.flag_columns(**gdp.ALLCOLUMNS))
+    for name in oscillations.INDICES:
+        loaders[f"index_{name}"] = functools.partial(oscillations.load, name)
+    return loaders
+
+
+def location():
+    """Return the active bundle directory or archive, None if there is none"""
+    if store.BUNDLE is not None:
+        return store.BUNDLE
+    path = store.path("bundle")
+    return path if os.path.isfile(os.path.join(path, MANIFEST)) else None
+
+
+def manifest(path=None):
+    """Return the manifest of a bundle, the active one if path is None"""
+    path = location() if path is None else path
+    if path is None:
+        return None
+    return _open(path)[0]
+
+
+def has(name):
+    """Return True if the active bundle holds the dataset"""
+    path = location()
+    return path is not None and name in _open(path)[0]["datasets"]
+
+
+def read(name, columns=None, filters=None):
+    """Read a dataset from the active bundle
+
+    Parameters
+    ----------
+    columns : list
+        Read only these columns
+    filters : list
+        Read only rows matching these filters, see filters.build
+    """
+    import pyarrow.parquet as pq
+    path = location()
+    meta, offsets = _open(path)
+    entry = meta["datasets"][name]
+    source = _source(path, entry["file"], offsets)
+    filters = rowfilters.resolve(filters, pq.read_schema(source()))
+    with instrument.stage("bundle_read", name=name,
+                          bytes=entry["size"]) as rec:
+        df = pq.read_table(source(), columns=columns, filters=filters,
+                           memory_map=True,
+                           use_pandas_metadata=True).to_pandas()
+        rec.rows = len(df)
+    return df
+
+
+def export(filename, names=None):
+    """Write datasets to a bundle archive and return its manifest
+
+    All datasets in datasets() are exported if names is None, skipping
+    with a warning those that can not be loaded. Datasets asked for by
+    name must load.
+    """
+    loaders = datasets()
+    entries = {}
+    filename = os.path.abspath(filename)
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(filename)) as tmpdirname:
+        for name in (loaders if names is None else names):
+            try:
+                df = loaders[name]()
+            except Exception as err:
+                if names is not None:
+                    raise
+                warnings.warn(f"Could not export '{name}': {err}")
+                continue
+            fn = os.path.join(tmpdirname, f"{name}.parquet")
+            df.to_parquet(fn, row_group_size=cache.ROWGROUP)
+            entries[name] = {"file":f"data/{name}.parquet",
+                             "sha256":_sha256(fn),
+                             "size":os.path.getsize(fn),
+                             "rows":len(df), "columns":list(df.columns)}
+        meta = {"format":FORMAT, "version":__version__,
+                "created":time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "datasets":entries}
+        tmpfn = store.tmpname(filename)
+        with tarfile.open(tmpfn, "w") as tf:
+            data = json.dumps(meta, indent=1).encode()
+            info = tarfile.TarInfo(MANIFEST)
+            info.size, info.mtime = len(data), time.time()
+            tf.addfile(info, io.BytesIO(data))
+            for name, entry in entries.items():
+                tf.add(os.path.join(tmpdirname, f"{name}.parquet"),
+                       entry["file"])
+        os.replace(tmpfn, filename)
+    return meta
+
+
+def install(filename, path=None):
+    """Verify a bundle archive and unpack it, to ROOT/bundle by default"""
+    path = store.path("bundle") if path is None else path
+    with store.lock("bundle"), tarfile.open(filename) as tf:
+        meta = _check(json.load(tf.extractfile(MANIFEST)))
+        tmpdirname = store.tmpname(path)
+        os.makedirs(os.path.join(tmpdirname, "data"), exist_ok=True)
+        try:
+            for name, entry in meta["datasets"].items():
+                fn = os.path.join(tmpdirname, entry["file"])
+                sha = hashlib.sha256()
+                with tf.extractfile(entry["file"]) as src, \
+                     open(fn, "wb") as dst:
+                    while block := src.read(BLOCKSIZE):
+                        sha.update(block)
+                        dst.write(block)
+                if sha.hexdigest() != entry["sha256"]:
+                    raise IOError(f"Checksum mismatch for '{name}' in "
+                                  f"{filename}")
+            with open(os.path.join(tmpdirname, MANIFEST), "w") as fH:
+                json.dump(meta, fH, indent=1)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.replace(tmpdirname, path)
+        finally:
+            shutil.rmtree(tmpdirname, ignore_errors=True)
+    return meta
+
+
+def verify(path=None):
+    """Return names of datasets whose checksum does not match the manifest"""
+    path = location() if path is None else path
+    meta, offsets = _open(path)
+    bad = []
+    for name, entry in meta["datasets"].items():
+        if offsets is None:
+            sha = _sha256(os.path.join(path, entry["file"]))
+        else:
+            sha = hashlib.sha256(
+                _source(path, entry["file"], offsets)().read()).hexdigest()
+        if sha != entry["sha256"]:
+            bad.append(name)
+    return bad
+
+
+def _open(path):
+    """Return manifest and member offsets of a bundle, memoized on mtime"""
+    isdir = os.path.isdir(path)
+    mtime = os.stat(os.path.join(path, MANIFEST) if isdir else path
+                    ).st_mtime_ns
+    if path in _memo and _memo[path][0] == mtime:
+        return _memo[path][1:]
+    if isdir:
+        with open(os.path.join(path, MANIFEST)) as fH:
+            meta, offsets = json.load(fH), None
+    else:
+        with tarfile.open(path) as tf:
+            meta = json.load(tf.extractfile(MANIFEST))
+            offsets = {info.name:(info.offset_data, info.size)
+                       for info in tf.getmembers() if info.isfile()}
+    _memo[path] = (mtime, _check(meta), offsets)
+    return _memo[path][1:]
+
+
+def _source(path, member, offsets):
+    """Return a function opening a parquet member of a bundle"""
+    if offsets is None:
+        return lambda: os.path.join(path, member)
+    import pyarrow as pa
+    offset, size = offsets[member]
+    buf = pa.memory_map(path).read_at(size, offset)
+    return lambda: pa.BufferReader(buf)
+
+
+def _check(meta):
+    if meta.get("format", 0) > FORMAT:
+        raise ValueError(f"Bundle format {meta['format']} needs a newer "
+                         "version of oceandata")
+    for entry in meta["datasets"].values():
+        if os.path.isabs(entry["file"]) or ".." in entry["file"].split("/"):
+            raise ValueError(f"Invalid file in bundle: {entry['file']}")
+    return meta
+
+
+def _sha256(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as fH:
+        for block in iter(lambda: fH.read(BLOCKSIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
@@ -0,0 +1,328 @@
+"""Columnar cache for cleaned dataframes
+
+Every loader parses its raw text/Excel/gzip file into a cleaned pandas
+dataframe. The result is stored here as a parquet file keyed on the sha1
+of the raw source file(s), the name of the loader, a loader schema version
+and a hash of the function that did the cleaning. A warm load is a single
+parquet read, and the entry is invalidated automatically as soon as either
+the raw file or the cleaning code changes. Generation is done under a
+store lock per dataset, so concurrent processes parse a file only once.
+
+Example:
+    df = cache.cached("mapps", fn, read_tab, version=1)
+
+"""
+import os
+import re
+import json
+import types
+import hashlib
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from . import instrument, store, filters as rowfilters
+
+CACHEDIR = store.path("cache")
+HASHFILE = "sources.json"
+BLOCKSIZE = 1 << 20
+ROWGROUP = 1 << 16
+
+
+def file_hash(filename, cachedir=None):
+    """Return sha1 of a file, memoized on size and modification time"""
+    return file_hashes([filename], cachedir=cachedir)[0]
+
+
+def file_hashes(filenames, cachedir=None):
+    """Return sha1 of several files, reading the memo file only once"""
+    cachedir = CACHEDIR if cachedir is None else cachedir
+    memo = _read_memo(cachedir)
+    hashes = []
+    changed = False
+    for filename in filenames:
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        entry = memo.get(filename)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            hashes.append(entry[2])
+            continue
+        sha = hashlib.sha1()
+        with open(filename, "rb") as fH, instrument.stage(
+                "hash", name=os.path.basename(filename), bytes=stat.st_size):
+            for block in iter(lambda: fH.read(BLOCKSIZE), b""):
+                sha.update(block)
+        memo[filename] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        hashes.append(sha.hexdigest())
+        changed = True
+    if changed:
+        _write_memo(cachedir, memo)
+    return hashes
+
+
+def code_hash(func):
+    """Return a hash of the bytecode and constants of a function
+
+    Functions and classes of the same package that the function uses,
+    such as pangaea.read_tab called from a loader's reader, are hashed
+    recursively, so editing a cleaning helper invalidates the cache too.
+    """
+    sha = hashlib.sha1()
+    package = func.__module__.split(".")[0]
+    seen = set()
+    def update(code):
+        sha.update(code.co_code)
+        sha.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                update(const)
+            else:
+                sha.update(repr(const).encode())
+    def visit(func):
+        if func in seen:
+            return
+        seen.add(func)
+        update(func.__code__)
+        for obj in _referenced(func, package):
+            if isinstance(obj, type):
+                for attr in vars(obj).values():
+                    if isinstance(attr, types.FunctionType):
+                        visit(attr)
+            else:
+                visit(obj)
+    visit(func)
+    return sha.hexdigest()
+
+
+def _referenced(func, package):
+    """Return functions and classes of package used by func"""
+    names = set()
+    def collect(code):
+        names.update(code.co_names)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                collect(const)
+    collect(func.__code__)
+    scopes = [func.__globals__]
+    scopes += [vars(obj) for obj in func.__globals__.values()
+               if isinstance(obj, types.ModuleType)
+               and obj.__name__.split(".")[0] == package]
+    found = []
+    for scope in scopes:
+        for name in sorted(names):
+            obj = scope.get(name)
+            if (isinstance(obj, (types.FunctionType, type)) and
+                    getattr(obj, "__module__", "").split(".")[0] == package):
+                found.append(obj)
+    return found
+
+
+def cache_key(name, sources, reader, version=1, kwargs=None, cachedir=None):
+    """Return key identifying a cleaned dataframe
+
+    The key starts with a hash of the reader kwargs, so entries read with
+    other kwargs are kept when a stale entry is replaced.
+    """
+    sha = hashlib.sha1(f"{name}:{version}".encode())
+    for digest in file_hashes(_as_list(sources), cachedir=cachedir):
+        sha.update(digest.encode())
+    sha.update(code_hash(reader).encode())
+    return f"{kwargs_hash(kwargs)}_{sha.hexdigest()[:16]}"
+
+
+def kwargs_hash(kwargs=None):
+    """Return a short hash of reader kwargs"""
+    kwargs = repr(sorted((kwargs or {}).items())).encode()
+    return hashlib.sha1(kwargs).hexdigest()[:8]
+
+
+def cache_path(name, key, cachedir=None):
+    cachedir = CACHEDIR if cachedir is None else cachedir
+    return os.path.join(cachedir, f"{name}_{key}.parquet")
+
+
+def cached(name, sources, reader, version=1, kwargs=None,
+           columns=None, filters=None, cachedir=None):
+    """Return cleaned dataframe from cache, generate it if necessary
+
+    Parameters
+    ----------
+    name : str
+        Name of the dataset, used as prefix for the cache file
+    sources : str or list
+        Raw file(s) the dataframe is generated from
+    reader : callable
+        Function called as reader(*sources, **kwargs) to parse raw files
+    version : int
+        Loader schema version, bump to invalidate existing caches
+    columns : list
+        Read only these columns from the cache
+    filters : list
+        Read only rows matching these filters, see filters.build
+    """
+    kwargs = {} if kwargs is None else kwargs
+    key = cache_key(name, sources, reader, version=version,
+                    kwargs=kwargs, cachedir=cachedir)
+    fn = cache_path(name, key, cachedir=cachedir)
+    if os.path.isfile(fn):
+        return read(fn, columns=columns, filters=filters)
+    with store.lock(f"cache_{name}"):
+        if os.path.isfile(fn):
+            return read(fn, columns=columns, filters=filters)
+        df = parse(name, sources, reader, kwargs)
+        write(df, name, key, cachedir=cachedir)
+    return rowfilters.apply(df, filters, columns)
+
+
+def parse(name, sources, reader, kwargs=None):
+    """Call reader on the sources as the 'parse' stage"""
+    sources = _as_list(sources)
+    with instrument.stage("parse", name=name, bytes=sum(
+            os.path.getsize(fn) for fn in sources)) as rec:
+        df = reader(*sources, **({} if kwargs is None else kwargs))
+        rec.rows = len(df)
+    return df
+
+
+def read(filenames, columns=None, filters=None):
+    """Read cached parquet file(s), evaluating filters while reading"""
+    import pyarrow.parquet as pq
+    filenames = _as_list(filenames)
+    if filters is not None:
+        filters = rowfilters.resolve(filters, pq.read_schema(filenames[0]))
+    with instrument.stage("cache_read", name=os.path.basename(filenames[0]),
+                          bytes=sum(os.path.getsize(fn) for fn in filenames)
+                          ) as rec:
+        if len(filenames) == 1:
+            df = pd.read_parquet(filenames[0], columns=columns,
+                                 filters=filters)
+        else:
+            df = pq.read_table(filenames, columns=columns, filters=filters,
+                               use_pandas_metadata=True).to_pandas()
+        rec.rows = len(df)
+    return df
+
+
+def generate(name, sources, reader, version=1, kwargs=None, cachedir=None):
+    """Generate cache file if missing and return its path
+
+    Returns None if the dataframe could not be written to the cache.
+    """
+    kwargs = {} if kwargs is None else kwargs
+    key = cache_key(name, sources, reader, version=version,
+                    kwargs=kwargs, cachedir=cachedir)
+    fn = cache_path(name, key, cachedir=cachedir)
+    if os.path.isfile(fn):
+        return fn
+    with store.lock(f"cache_{name}"):
+        if not os.path.isfile(fn):
+            df = parse(name, sources, reader, kwargs)
+            fn = write(df, name, key, cachedir=cachedir)
+    return fn
+
+
+def write(df, name, key, cachedir=None):
+    """Write dataframe to cache and remove stale entries with same name"""
+    fn = cache_path(name, key, cachedir=cachedir)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    tmpfn = store.tmpname(fn)
+    try:
+        with instrument.stage("cache_write", name=name, rows=len(df)) as rec:
+            df.to_parquet(tmpfn, row_group_size=ROWGROUP)
+            rec.bytes = os.path.getsize(tmpfn)
+    except (ImportError, ValueError, TypeError) as err:
+        warnings.warn(f"Could not cache '{name}': {err}")
+        if os.path.isfile(tmpfn):
+            os.unlink(tmpfn)
+        return None
+    os.replace(tmpfn, fn)
+    for stale in entries(name, kwhash=key.split("_")[0], cachedir=cachedir):
+        if stale != fn:
+            os.unlink(stale)
+    return fn
+
+
+def entries(name=None, kwhash=None, cachedir=None):
+    """Return cache files of a dataset, of all datasets if name is None
+
+    Only files named exactly {name}_{kwhash}_{key}.parquet match, so
+    datasets sharing a prefix, like mapps and mapps_pml, are kept apart.
+    """
+    cachedir = CACHEDIR if cachedir is None else cachedir
+    regex = re.compile(r"{}_{}_[0-9a-f]{{16}}\.parquet$".format(
+        ".+" if name is None else re.escape(name),
+        "[0-9a-f]{8}" if kwhash is None else re.escape(kwhash)))
+    try:
+        names = os.listdir(cachedir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(cachedir, fn) for fn in sorted(names)
+            if regex.match(fn)]
+
+
+def compact(df, categories=None, integers=None):
+    """Return dataframe with compact dtypes
+
+    Floats become float32 and integers int32 when the values fit. String
+    columns with repeated labels, and the columns in categories, become
+    categoricals. The float columns in integers, typically integer fields
+    with missing values, become nullable Int32.
+    """
+    categories = [] if categories is None else list(categories)
+    integers = [] if integers is None else list(integers)
+    dtypes = {}
+    for key, col in df.items():
+        if key in categories:
+            dtypes[key] = "category"
+        elif key in integers and _integral(col):
+            dtypes[key] = "Int32" if _fits(col, np.int32) else "Int64"
+        elif col.dtype == np.float64:
+            dtypes[key] = np.float32
+        elif col.dtype == np.int64 and _fits(col, np.int32):
+            dtypes[key] = np.int32
+        elif (col.dtype == object or isinstance(col.dtype, pd.StringDtype)):
+            if (pd.api.types.infer_dtype(col, skipna=True) == "string" and
+                    col.nunique() <= len(col) // 2):
+                dtypes[key] = "category"
+    return df.astype(dtypes)
+
+
+def _fits(col, dtype):
+    info = np.iinfo(dtype)
+    return len(col) == 0 or (col.min() >= info.min and col.max() <= info.max)
+
+
+def _integral(col):
+    values = col.dropna().values
+    return pd.api.types.is_numeric_dtype(col) and bool(
+        np.all(np.mod(values, 1) == 0))
+
+
+def clear(name=None, cachedir=None):
+    """Remove cached dataframes, all of them if name is None"""
+    for fn in entries(name, cachedir=cachedir):
+        os.unlink(fn)
+
+
+def _as_list(sources):
+    if isinstance(sources, (str, os.PathLike)):
+        return [sources]
+    return list(sources)
+
+
+def _read_memo(cachedir):
+    try:
+        with open(os.path.join(cachedir, HASHFILE)) as fH:
+            return json.load(fH)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_memo(cachedir, memo):
+    os.makedirs(cachedir, exist_ok=True)
+    fn = os.path.join(cachedir, HASHFILE)
+    tmpfn = store.tmpname(fn)
+    with open(tmpfn, "w") as fH:
+        json.dump(memo, fH)
+    os.replace(tmpfn, fn)
@@ -1,6 +1,17 @@
-
-from .valente import load as load_valente
+import importlib
 
 def load():
+    from .valente import load as load_valente
     print("Loading Chl data from the Valente database")
     load_valente()
+
+def __getattr__(name):
+    if name == "valente":
+        return importlib.import_module(".valente", __name__)
+    if name == "load_valente":
+        from .valente import load
+        return load
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | {"valente", "load_valente"})
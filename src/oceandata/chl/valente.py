@@ -39,22 +39,69 @@ import warnings
 
 import numpy as np
 import pandas as pd
-import requests
 
-DATADIR = os.path.expanduser("~/.oceandata/valente")
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+from .. import bundle, cache, downloader, filters, instrument, pangaea, store
 
-def load(datadir=DATADIR, filename="insitudb_chla_V3.tab"):
-    """Load tab file and fix some columns"""
+DATADIR = store.path("valente")
+FILENAME = "insitudb_chla_V3.tab"
+CACHE_VERSION = 1
+ARCHIVES = {2:("https://doi.pangaea.de/10.1594/PANGAEA.898188",
+               "valente_2019.zip"),
+            3:("https://doi.pangaea.de/10.1594/PANGAEA.941318",
+               "valente_2022.zip")}
+
+@instrument.timed("load", name="valente_chl")
+def load(datadir=None, filename=None, compact=False,
+         bbox=None, start=None, end=None, columns=None, depth=None):
+    """Load tab file and fix some columns
+
+    The tab file is parsed straight out of the downloaded zip archive. The
+    positions in bbox = (lon1, lat1, lon2, lat2), the times between start
+    and end and the given columns are selected while reading the cache
+    (see filters.build). The dataset has no depth column. With
+    compact=True floats are returned as float32 and repeated labels such
+    as the data source as categoricals. The dataset is read from the
+    active bundle when it holds one, unless datadir or filename is given.
+    """
+    dnf = filters.build(bbox, start, end, depth)
+    if datadir is None and filename is None and bundle.has("valente_chl"):
+        df = bundle.read("valente_chl", columns=columns, filters=dnf)
+    else:
+        datadir = DATADIR if datadir is None else datadir
+        filename = FILENAME if filename is None else filename
+        fn, member = source(filename, datadir=datadir)
+        df = cache.cached("valente_chl", fn, read_tab, version=CACHE_VERSION,
+                          kwargs={"member":member}, columns=columns,
+                          filters=dnf)
+    return cache.compact(df) if compact else df
+
+def source(filename, datadir=None, version=3):
+    """Return archive and member holding filename, download if missing
+
+    Files extracted by earlier versions of this module are used directly,
+    in which case the member is None.
+    """
+    datadir = DATADIR if datadir is None else datadir
     fn = os.path.join(datadir, "datasets", filename)
-    if not os.path.isfile(fn):
-        download(datadir=datadir, filename=filename)
-    with open(fn ,"r") as fH: 
-        while 1: 
-            line = fH.readline() 
-            if "*/" in line: 
-                break
-        df = pd.read_csv(fH, sep="\t", parse_dates=[1,])
+    if os.path.isfile(fn):
+        return fn, None
+    zipfilename = os.path.join(datadir, ARCHIVES[version][1])
+    with store.lock("valente"):
+        if not os.path.isfile(zipfilename):
+            download(version=version, datadir=datadir)
+    return zipfilename, zip_member(zipfilename, filename)
+
+def zip_member(zipfilename, filename):
+    """Return name of the archive member with the file name filename"""
+    with zipfile.ZipFile(zipfilename) as zip_ref:
+        for name in zip_ref.namelist():
+            if os.path.basename(name) == filename:
+                return name
+    raise KeyError(f"'{filename}' is not in {zipfilename}")
+
+def read_tab(filename, member=None):
+    """Read Pangaea tab file and clean columns"""
+    df = pangaea.read_tab(filename, member=member)
     df["lat"] = df["Latitude"]
     df["lon"] = df["Longitude"]
     df["chl_hpcl"] = df["Chl a [mg/m**3] (High Performance Liquid Chrom...)"]
@@ -68,44 +115,16 @@ def load(datadir=DATADIR, filename="insitudb_chla_V3.tab"):
 
 def download(version=3,
              params={"format":"zip"},
-             datadir=DATADIR,
+             datadir=None,
              filename=None):
-    """Download tsv file from Pangaea server
-    Refs
-    ----
-    Zipfile https://stackoverflow.com/questions/3451111/unzipping-files-in-python
-    """
-    if version == 2:
-        url="https://doi.pangaea.de/10.1594/PANGAEA.898188"
-        zipfilename = "valente_2019.zip"
-    else:
-        url = "https://doi.pangaea.de/10.1594/PANGAEA.941318"
-        zipfilename = "valente_2022.zip"
-    zipfilename = os.path.join(DATADIR, zipfilename)
-    try:
-        os.unlink(zipfilename)
-    except FileNotFoundError:
-        pass
-
-    try:
-        r = requests.get(url, params=params, stream=True, timeout=6)
-    except requests.ReadTimeout:
-        warnings.warn("Connection to server timed out.")
-        return False
-    if r.ok:
-        if zipfilename is None:
-            return r.text
-        else:
-            with open(zipfilename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024): 
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-    else:
-        raise IOError("Could not download file from server")
+    """Download zip archive with all datasets from Pangaea server
 
-    with zipfile.ZipFile(zipfilename,"r") as zip_ref:
-        zip_ref.extractall(datadir)
+    The archive is kept as is, the loaders read their member from it.
+    """
+    datadir = DATADIR if datadir is None else datadir
+    url, zipfilename = ARCHIVES[version]
+    zipfilename = os.path.join(datadir, zipfilename)
+    return downloader.fetch(url, zipfilename, params=params)
 
 
 def download_pml(url="https://github.com/brorfred/oceandata/raw/master/data/",
@@ -0,0 +1,65 @@
+"""Command line interface, installed as the oceandata script
+
+Example:
+    oceandata bundle export oceandata.tar
+    oceandata bundle export mapps.tar -d mapps -d mapps_pml
+    oceandata bundle import oceandata.tar
+    oceandata bundle verify oceandata.tar
+
+"""
+import click
+
+from . import bundle as _bundle
+
+
+@click.group()
+def cli():
+    """Download, parse and bundle in situ ocean datasets"""
+
+
+@cli.group()
+def bundle():
+    """Portable bundles of pre-parsed datasets"""
+
+
+@bundle.command("export")
+@click.argument("filename", type=click.Path(dir_okay=False))
+@click.option("--dataset", "-d", "names", multiple=True,
+              help="Dataset to export, all if not given")
+def export_cmd(filename, names):
+    """Write cleaned datasets to a bundle archive"""
+    meta = _bundle.export(filename, names=list(names) or None)
+    for name, entry in meta["datasets"].items():
+        click.echo(f"{name:20s} {entry['rows']:10d} rows "
+                   f"{entry['size'] / 2**20:8.1f} MB")
+    click.echo(f"Wrote {len(meta['datasets'])} datasets to {filename}")
+
+
+@bundle.command("import")
+@click.argument("filename", type=click.Path(exists=True, dir_okay=False))
+@click.option("--path", type=click.Path(file_okay=False),
+              help="Directory to unpack to, ROOT/bundle by default")
+def import_cmd(filename, path):
+    """Verify a bundle archive and unpack it into the store"""
+    meta = _bundle.install(filename, path=path)
+    click.echo(f"Imported {len(meta['datasets'])} datasets "
+               f"(oceandata {meta['version']}, created {meta['created']})")
+
+
+@bundle.command("verify")
+@click.argument("path", required=False, type=click.Path(exists=True))
+def verify_cmd(path):
+    """Check the checksums of a bundle, the active one by default"""
+    path = _bundle.location() if path is None else path
+    if path is None:
+        raise click.ClickException("No active bundle")
+    bad = _bundle.verify(path)
+    for name in bad:
+        click.echo(f"Checksum mismatch: {name}")
+    if bad:
+        raise SystemExit(1)
+    click.echo(f"{len(_bundle.manifest(path)['datasets'])} datasets OK")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,198 @@
+"""Shared HTTP downloader for all datasets
+
+All downloads go through one pooled requests.Session, so connections to
+the same server are reused. Files are streamed to disk in large blocks and
+several files can be fetched concurrently on a bounded thread pool.
+
+The ETag and Last-Modified headers of every download are kept in a json
+file next to it, so refreshing an unchanged file is a single conditional
+request. Data are written to a .part file that is resumed with a Range
+request if the connection drops, verified, and renamed into place. A
+store lock per local file keeps concurrent processes from downloading the
+same file twice.
+
+The sha256 of every download is stored in its json file. A download is
+verified against the checksum given to fetch(), else against the stored
+sha256 when the server sends the same strong ETag again. A resumed
+download must have the validator and full length of the first request.
+Without a checksum or a strong ETag only these lengths are checked.
+
+Example:
+    downloader.fetch(url, "GO_flux.tab", params={"format":"textfile"})
+    downloader.fetch_many(urls, filenames, workers=8)
+
+"""
+import os
+import json
+import hashlib
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from . import instrument, store
+
+CHUNKSIZE = 1 << 20
+TIMEOUT = 6
+WORKERS = 8
+
+_lock = threading.Lock()
+_session = None
+
+
+def session():
+    """Return the shared session, create it on first use"""
+    global _session
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=WORKERS,
+                                  pool_maxsize=WORKERS)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
+
+def fetch(url, local_filename, params=None, timeout=TIMEOUT, checksum=None):
+    """Download url to local_filename
+
+    Parameters
+    ----------
+    checksum : str
+        Expected sha256 hex digest of the file. If None, the sha256 stored
+        for an earlier download with the same strong ETag is used.
+
+    Returns local_filename, or False if the server timed out.
+    """
+    local_filename = str(local_filename)
+    name = hashlib.sha1(os.path.abspath(local_filename).encode()).hexdigest()
+    with store.lock(f"download_{name[:16]}"), instrument.stage(
+            "download", name=url) as rec:
+        return _fetch(url, local_filename, params, timeout, checksum, rec)
+
+
+def _fetch(url, local_filename, params, timeout, checksum, rec):
+    import requests
+    os.makedirs(os.path.dirname(os.path.abspath(local_filename)), exist_ok=True)
+    partfile = local_filename + ".part"
+    meta = read_meta(local_filename) if os.path.isfile(local_filename) else {}
+    partmeta = read_meta(partfile) if os.path.isfile(partfile) else {}
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    validator = partmeta.get("etag") or partmeta.get("last_modified")
+    offset = os.path.getsize(partfile) if validator else 0
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+    try:
+        r = session().get(url, params=params, stream=True, timeout=timeout,
+                          headers=headers)
+    except requests.ReadTimeout:
+        warnings.warn("Connection to server timed out.")
+        return False
+    with r:
+        if r.status_code == 304:
+            _remove(partfile, partfile + ".json")
+            rec.bytes = 0
+            return local_filename
+        if not r.ok:
+            raise IOError(
+                f"Could not download file from server, Error {r.status_code}")
+        if r.status_code != 206 or not r.headers.get(
+                "Content-Range", "").startswith(f"bytes {offset}-"):
+            offset = 0
+        newmeta = {"url":r.url,
+                   "etag":r.headers.get("ETag"),
+                   "last_modified":r.headers.get("Last-Modified"),
+                   "length":_full_length(r, offset)}
+        changed = [key for key in ("etag", "length")
+                   if partmeta.get(key) not in (None, newmeta[key])]
+        if offset and changed:
+            _remove(partfile, partfile + ".json")
+            raise IOError(f"Can not resume {url}, the file on the server "
+                          "differs from the partial download")
+        write_meta(partfile, newmeta)
+        sha = hashlib.sha256()
+        if offset:
+            with open(partfile, "rb") as f:
+                for block in iter(lambda: f.read(CHUNKSIZE), b""):
+                    sha.update(block)
+        with open(partfile, "ab" if offset else "wb",
+                  buffering=CHUNKSIZE) as f:
+            for chunk in r.iter_content(chunk_size=CHUNKSIZE):
+                sha.update(chunk)
+                f.write(chunk)
+        size = os.path.getsize(partfile)
+        rec.bytes = size - offset
+        if newmeta["length"] is not None and size != newmeta["length"]:
+            if size > newmeta["length"]:
+                _remove(partfile, partfile + ".json")
+            raise IOError(f"Incomplete download of {url}, "
+                          f"{size} of {newmeta['length']} bytes")
+    etag = newmeta["etag"]
+    if (checksum is None and etag and not etag.startswith("W/") and
+            meta.get("etag") == etag):
+        checksum = meta.get("sha256")
+    if checksum is not None and sha.hexdigest() != checksum.lower():
+        _remove(partfile, partfile + ".json")
+        raise IOError(f"Checksum mismatch for {url}")
+    newmeta.update({"size":size, "sha256":sha.hexdigest()})
+    os.replace(partfile, local_filename)
+    write_meta(local_filename, newmeta)
+    _remove(partfile + ".json")
+    return local_filename
+
+
+def _full_length(r, offset):
+    """Return size of the whole file from the headers, None if not known"""
+    if "Content-Encoding" in r.headers:
+        return None
+    if offset:
+        total = r.headers["Content-Range"].rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+    length = r.headers.get("Content-Length")
+    return int(length) if length is not None else None
+
+
+def read_meta(local_filename):
+    """Return stored headers and checksum of a downloaded file"""
+    try:
+        with open(f"{local_filename}.json") as fH:
+            return json.load(fH)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_meta(local_filename, meta):
+    tmpfn = store.tmpname(f"{local_filename}.json")
+    with open(tmpfn, "w") as fH:
+        json.dump(meta, fH)
+    os.replace(tmpfn, f"{local_filename}.json")
+
+
+def _remove(*filenames):
+    for fn in filenames:
+        try:
+            os.unlink(fn)
+        except FileNotFoundError:
+            pass
+
+
+def fetch_many(urls, local_filenames, params=None, timeout=TIMEOUT,
+               workers=WORKERS, callback=None):
+    """Download several urls concurrently on a bounded thread pool
+
+    callback is called with each local filename as it finishes.
+    """
+    urls, local_filenames = list(urls), list(local_filenames)
+    def job(url, local_filename):
+        result = fetch(url, local_filename, params=params, timeout=timeout)
+        if callback is not None:
+            callback(local_filename)
+        return result
+    with ThreadPoolExecutor(max(1, min(workers, len(urls)))) as pool:
+        return list(pool.map(job, urls, local_filenames))
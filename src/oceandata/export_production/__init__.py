@@ -1,2 +1,11 @@
+import importlib
 
-from . import mouw
\ No newline at end of file
+SUBMODULES = ["mouw"]
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
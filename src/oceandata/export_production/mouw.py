@@ -9,11 +9,14 @@ import warnings
 
 import pandas as pd
 import numpy as np
-import requests
 
-DATADIR = pathlib.PurePath(pathlib.Path.home(), ".oceandata")
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+from .. import bundle, cache, downloader, filters, instrument, pangaea, store
+
+DATADIR = pathlib.PurePath(store.path())
 DATAURL = "https://doi.pangaea.de/10.1594/PANGAEA.855594"
+FILENAME = "GO_flux.tab"
+CACHE_VERSION = 1
+CATEGORIES = ["sampling_type", "ref_ID", "UUID"]
 
 """
 def load():
@@ -28,17 +31,40 @@ def load():
     return df
 """
 
-def load(datadir=DATADIR, filename="GO_flux.tab", with_std=False):
-    """Load tab file and fix some columns"""
-    fn = os.path.join(datadir, filename)
-    if not os.path.isfile(fn):
-        download(datadir=datadir, filename=filename)
-    with open(fn ,"r") as fH: 
-        while 1: 
-            line = fH.readline() 
-            if "*/" in line: 
-                break
-        df = pd.read_csv(fH, sep="\t", parse_dates=[1,])
+@instrument.timed("load", name="mouw")
+def load(datadir=None, filename=None, with_std=False,
+         compact=False, bbox=None, start=None, end=None, columns=None,
+         depth=None):
+    """Load tab file and fix some columns
+
+    Rows in bbox = (lon1, lat1, lon2, lat2), with trap retrieval times
+    between start and end and trap depths in depth are selected while
+    reading the cache, see filters.build. With compact=True floats are
+    returned as float32 and sampling_type, ref_ID and UUID as categoricals.
+    The dataset is read from the active bundle when it holds one, unless
+    datadir or filename is given.
+    """
+    dnf = filters.build(bbox, start, end, depth)
+    name = "mouw_std" if with_std else "mouw"
+    if datadir is None and filename is None and bundle.has(name):
+        df = bundle.read(name, columns=columns, filters=dnf)
+    else:
+        datadir = DATADIR if datadir is None else datadir
+        filename = FILENAME if filename is None else filename
+        fn = os.path.join(datadir, filename)
+        with store.lock("mouw"):
+            if not os.path.isfile(fn):
+                download(datadir=datadir, filename=filename)
+        df = cache.cached("mouw", fn, read_tab, version=CACHE_VERSION,
+                          kwargs={"with_std":with_std}, columns=columns,
+                          filters=dnf)
+    if compact:
+        return cache.compact(df, categories=CATEGORIES)
+    return df
+
+def read_tab(filename, with_std=False):
+    """Read Pangaea tab file and clean columns"""
+    df = pangaea.read_tab(filename)
 
     if not with_std:
         df.drop(columns=['Flux std dev [±]', 'C flux [mg/m**2/day]', 
@@ -87,30 +113,12 @@ def load(datadir=DATADIR, filename="GO_flux.tab", with_std=False):
     df.set_index("end_time", inplace=True)
     return df
 
-def download(datadir=DATADIR, filename="GO_flux.tab"):
+def download(datadir=None, filename="GO_flux.tab"):
     """Download txt file from BATS server
     
     Refs
     ----
     """
+    datadir = DATADIR if datadir is None else datadir
     local_filename = os.path.join(datadir, filename)
-    try:
-        os.unlink(local_filename)
-    except FileNotFoundError:
-        pass
-    try:
-        r = requests.get(DATAURL, stream=True, timeout=6, params={"format":"textfile"})
-    except requests.ReadTimeout:
-        warnings.warn("Connection to server timed out.")
-        return False
-    if r.ok:
-        if local_filename is None:
-            return r.text
-        else:
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024): 
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-    else:
-        raise IOError(f"Could not download file from server, Error {r.status_code}")
+    return downloader.fetch(DATAURL, local_filename, params={"format":"textfile"})
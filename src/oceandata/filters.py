@@ -0,0 +1,108 @@
+"""Row filters shared by the dataset loaders
+
+All loaders take the same bbox, start, end and depth arguments. They are
+translated to filters in disjunctive normal form, a list of lists of
+(column, op, value) tuples as used by pyarrow, which are evaluated while
+the parquet cache is read. Row groups outside the range are skipped using
+their statistics, so excluded rows are never materialised. The column
+None refers to the datetime index of the dataframe.
+
+Example:
+    dnf = filters.build(bbox=(-80, 20, -60, 45), start="2005-01-01")
+    df = cache.cached("mapps", fn, read_tab, filters=dnf)
+
+"""
+import operator
+
+import numpy as np
+import pandas as pd
+
+OPS = {"==":operator.eq, "!=":operator.ne, "<":operator.lt,
+       "<=":operator.le, ">":operator.gt, ">=":operator.ge}
+
+
+def bbox_mask(lon, lat, bbox):
+    """Return mask of positions inside bbox = (lon1, lat1, lon2, lat2)
+
+    The box crosses the dateline when lon1 > lon2.
+    """
+    lon1, lat1, lon2, lat2 = bbox
+    lon, lat = np.asarray(lon), np.asarray(lat)
+    mask = (lat >= lat1) & (lat <= lat2)
+    if lon1 <= lon2:
+        return mask & (lon >= lon1) & (lon <= lon2)
+    return mask & ((lon >= lon1) | (lon <= lon2))
+
+
+def build(bbox=None, start=None, end=None, depth=None):
+    """Return filters for a query, None if nothing is filtered
+
+    Parameters
+    ----------
+    bbox : tuple
+        (lon1, lat1, lon2, lat2), crossing the dateline if lon1 > lon2
+    start, end : str or Timestamp
+        Inclusive time range of the datetime index
+    depth : float or tuple
+        Maximum depth, or (min, max) depth range
+    """
+    terms = []
+    if start is not None:
+        terms.append((None, ">=", pd.Timestamp(start)))
+    if end is not None:
+        terms.append((None, "<=", pd.Timestamp(end)))
+    if depth is not None:
+        dmin, dmax = depth if np.ndim(depth) else (None, depth)
+        if dmin is not None:
+            terms.append(("depth", ">=", dmin))
+        if dmax is not None:
+            terms.append(("depth", "<=", dmax))
+    if bbox is None:
+        return [terms] if terms else None
+    lon1, lat1, lon2, lat2 = bbox
+    terms += [("lat", ">=", lat1), ("lat", "<=", lat2)]
+    if lon1 <= lon2:
+        return [terms + [("lon", ">=", lon1), ("lon", "<=", lon2)]]
+    return [terms + [("lon", ">=", lon1)], terms + [("lon", "<=", lon2)]]
+
+
+def mask(df, dnf):
+    """Evaluate filters on a dataframe, return boolean row mask"""
+    result = np.zeros(len(df), dtype=bool)
+    for terms in dnf:
+        conj = np.ones(len(df), dtype=bool)
+        for key, op, value in terms:
+            if key is not None and key not in df:
+                raise KeyError(f"'{key}' is not a column of the dataset")
+            values = df.index if key is None else df[key]
+            conj &= np.asarray(OPS[op](values, value), dtype=bool)
+        result |= conj
+    return result
+
+
+def apply(df, dnf=None, columns=None):
+    """Filter rows and select columns of a dataframe in memory"""
+    if dnf is not None:
+        df = df[mask(df, dnf)]
+    return df if columns is None else df[list(columns)]
+
+
+def resolve(dnf, schema):
+    """Map index references to field names of a parquet schema"""
+    if dnf is None:
+        return None
+    index = [col for col in (schema.pandas_metadata or {}).get(
+        "index_columns", []) if isinstance(col, str)]
+    resolved = []
+    for terms in dnf:
+        conj = []
+        for key, op, value in terms:
+            if key is None:
+                if not index:
+                    raise KeyError("The dataset has no datetime index")
+                key = index[0]
+            elif key not in schema.names:
+                raise KeyError(f"'{key}' is not a column of the dataset")
+            conj.append((key, op, value))
+        resolved.append(conj)
+    return resolved
@@ -7,77 +7,555 @@ https://www.aoml.noaa.gov/phod/gdp/
 """
 import os
 import glob
+import json
+import shutil
 import pathlib
 import ftplib
 from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
 
 
 
 import numpy as np
 import pandas as pd
 
-import requests
-import click
 
-DATADIR = os.path.expanduser("~/.oceandata/")
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+from . import bundle, cache, filters, instrument, store
 
-def read_dat(filename, sst=False, vel=False, var=False):
-    df = pd.read_csv(filename, sep=" ", skipinitialspace=True,
-                     compression='gzip', na_values=999.999,
-                     names=["id", "month", "day", "year", "lat", "lon",
-                            "sst", "vel_east", "vel_north", "speed",
-                            "var_lat", "var_lon", "var_temp"])
+DATADIR = store.path()
+CACHE_VERSION = 1
+
+NAMES = ["id", "month", "day", "year", "lat", "lon",
+         "sst", "vel_east", "vel_north", "speed",
+         "var_lat", "var_lon", "var_temp"]
+COLUMNS = ["id", "lat", "lon", "sst", "vel_east", "vel_north", "speed",
+           "var_lat", "var_lon", "var_temp"]
+SEGMENTS = {1:5000, 5001:10000, 10001:15000, 15001:"current"}
+CHUNKSIZE = 500_000
+ALLCOLUMNS = dict(sst=True, vel=True, var=True)
+KINEMATICS = ["displacement", "heading", "ground_speed", "acceleration",
+              "curvature", "age"]
+TRAJDIR = os.path.join(DATADIR, "buoydata_trajectories")
+INDEXRES = 5
+
+def flag_columns(sst=False, vel=False, var=False):
+    """Return the columns selected by the sst, vel, and var flags"""
+    columns = ["id", "lat", "lon"]
+    if sst:
+        columns += ["sst"]
+    if vel:
+        columns += ["vel_east", "vel_north", "speed"]
+    if var:
+        columns += ["var_lat", "var_lon", "var_temp"]
+    return columns
+
+def segment_filename(v1):
+    """Return local filename of the dat file starting at drifter v1"""
+    return os.path.join(DATADIR, f"buoydata_{v1}_{SEGMENTS[v1]}.dat.gz")
+
+def fetch_segment(v1):
+    """Download the dat file starting at drifter v1 if missing"""
+    filename = segment_filename(v1)
+    with store.lock(f"gdp_{v1}"):
+        if not os.path.isfile(filename):
+            print("Downloading file")
+            download(v1=v1, v2=SEGMENTS[v1])
+    return filename
+
+def _clean(df):
+    """Create datetime index from year/month/day columns and wrap lon"""
     df["hour"] = ((df.day - df["day"].astype(int)) * 24).astype(np.int32)
     df.set_index(pd.to_datetime(df[["year","month","day","hour"]]),inplace=True)
     del df["year"], df["month"], df["day"], df["hour"]
-    df.loc[df["lon"]>180, "lon"] = df.loc[df["lon"]>180, "lon"] - 360
-    if not sst:
-        del df["sst"]
-    if not vel:
-        del df["vel_east"], df["vel_north"], df["speed"]
-    if not var:
-        del df["var_lat"], df["var_lon"], df["var_temp"]
+    if "lon" in df:
+        df.loc[df["lon"]>180, "lon"] = df.loc[df["lon"]>180, "lon"] - 360
     return df
 
-def load(v1=None, sst=False, vel=False, var=False):
-    """Load gzipped dat file to a pandas dataframe"""
-    if v1 is None:
-        dflist = []
-        for v1 in [1, 5001, 10001, 15001]:
-            dflist.append(load(v1, sst=sst, vel=vel, var=var))
-        return pd.concat(dflist)
-    if   v1 == 1:
-        v2 = 5000
-    elif v1 == 5001:
-        v2 = 10000
-    elif v1 == 10001:
-        v2 = 15000
-    elif v1 == 15001:
-        v2 = "current"
-    filename = os.path.join(DATADIR, f"buoydata_{v1}_{v2}.dat.gz")
-    h5filename = filename[:-7] + ".h5"
-    if os.path.isfile(h5filename):
-        return pd.read_hdf(h5filename)
-    if not os.path.isfile(filename):
-        print("Downloading file")
-        download(v1=v1, v2=v2)
-    df = read_dat(filename, sst=sst, vel=vel, var=var)
-    df.to_hdf(h5filename, "df")
+def read_dat(filename, sst=False, vel=False, var=False):
+    usecols = flag_columns(sst=sst, vel=vel, var=var) + ["year","month","day"]
+    with instrument.stage("read_csv", name=os.path.basename(filename),
+                          bytes=os.path.getsize(filename)) as rec:
+        df = pd.read_csv(filename, sep=" ", skipinitialspace=True,
+                         compression='gzip', na_values=999.999, names=NAMES,
+                         usecols=[key for key in NAMES if key in usecols])
+        rec.rows = len(df)
+    with instrument.stage("datetime", name=os.path.basename(filename),
+                          rows=len(df)):
+        return _clean(df)
+
+def iter_chunks(v1=None, bbox=None, start=None, end=None, ids=None,
+                columns=None, chunksize=CHUNKSIZE, filename=None):
+    """Iterate over filtered chunks of one or all gzipped dat files
+
+    The file is decompressed and parsed chunksize rows at a time and each
+    chunk is filtered before it is yielded, so peak memory is bounded by
+    the chunk size rather than by the size of the file.
+
+    Parameters
+    ----------
+    v1 : int
+        First drifter of the segment to read, all segments if None
+    bbox : tuple
+        (lon1, lat1, lon2, lat2) box to keep. Boxes crossing the dateline
+        are given with lon1 > lon2.
+    start, end : str or datetime
+        Keep observations with start <= time <= end
+    ids : list
+        Keep only these drifter ids
+    columns : list
+        Columns to return, all in COLUMNS if None
+    filename : str
+        Read this dat file instead of the downloaded segments
+    """
+    columns = COLUMNS if columns is None else list(columns)
+    for key in columns:
+        if key not in COLUMNS:
+            raise KeyError(f"'{key}' is not a GDP column")
+    usecols = set(columns) | {"year", "month", "day"}
+    if bbox is not None:
+        usecols |= {"lat", "lon"}
+    if ids is not None:
+        usecols |= {"id"}
+        ids = np.asarray(ids)
+    if filename is not None:
+        filenames = [filename]
+    else:
+        filenames = []
+        for v in (SEGMENTS if v1 is None else [v1]):
+            filenames.append(fetch_segment(v))
+    for fn in filenames:
+        reader = pd.read_csv(fn, sep=" ", skipinitialspace=True,
+                             compression='gzip', na_values=999.999,
+                             names=NAMES, chunksize=chunksize,
+                             usecols=[key for key in NAMES if key in usecols])
+        with reader:
+            for df in reader:
+                if ids is not None:
+                    df = df[df["id"].isin(ids)]
+                df = _clean(df)
+                mask = np.ones(len(df), dtype=bool)
+                if bbox is not None:
+                    mask &= filters.bbox_mask(df["lon"], df["lat"], bbox)
+                if start is not None:
+                    mask &= df.index >= pd.Timestamp(start)
+                if end is not None:
+                    mask &= df.index <= pd.Timestamp(end)
+                if mask.any():
+                    yield df.loc[mask, columns]
+
+def kinematics(df, t0=None):
+    """Add kinematics derived from the positions of drifter fixes
+
+    All drifters are processed in one vectorised pass over arrays sorted
+    by id and time, using the boundaries between drifters instead of a
+    groupby. The frame is sorted first if needed. New columns:
+
+        displacement  great-circle distance from the previous fix (m)
+        heading       direction from the previous fix (degrees from north)
+        ground_speed  displacement over time step (m/s)
+        acceleration  change of ground_speed between steps (m/s2)
+        curvature     change of heading per distance travelled (rad/m)
+        age           time since the first fix of the drifter (days)
+
+    Quantities needing earlier fixes of the same drifter are NaN.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Fixes with id, lat and lon columns and a datetime index
+    t0 : Timestamp
+        Deployment time of the first drifter in df, if it started before
+        the first fix in df. Used by iter_kinematics.
+    """
+    with instrument.stage("kinematics", rows=len(df)):
+        ids = np.asarray(df["id"])
+        t = df.index.values.astype("M8[ns]").astype(np.int64) / 1e9
+        if not np.all((ids[1:] > ids[:-1]) |
+                      ((ids[1:] == ids[:-1]) & (t[1:] >= t[:-1]))):
+            order = np.lexsort((t, ids))
+            df, ids, t = df.iloc[order], ids[order], t[order]
+        columns = _kinematics(ids, t, df["lat"].values, df["lon"].values,
+                              None if t0 is None else
+                              pd.Timestamp(t0).value / 1e9)
+        return df.assign(**columns)
+
+def _kinematics(ids, t, lat, lon, t0=None, radius=6371e3):
+    """Return kinematics of positions sorted by id and time"""
+    same = np.zeros(len(ids), dtype=bool)
+    same[1:] = ids[1:] == ids[:-1]
+    starts = np.flatnonzero(~same)
+    deployed = np.repeat(t[starts], np.diff(np.append(starts, len(ids))))
+    if t0 is not None and len(starts):
+        deployed[:starts[1] if len(starts) > 1 else len(ids)] = t0
+    lat, lon = np.radians(lat), np.radians(lon)
+    dlon = np.diff(lon)
+    hav = (np.sin(np.diff(lat) / 2)**2 +
+           np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2)**2)
+    dist = 2 * radius * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+    bearing = np.arctan2(np.sin(dlon) * np.cos(lat[1:]),
+                         np.cos(lat[:-1]) * np.sin(lat[1:]) -
+                         np.sin(lat[:-1]) * np.cos(lat[1:]) * np.cos(dlon))
+    displacement = np.full(len(ids), np.nan)
+    heading = np.full(len(ids), np.nan)
+    displacement[1:] = np.where(same[1:], dist, np.nan)
+    heading[1:] = np.where(same[1:], bearing, np.nan)
+    speed = np.full(len(ids), np.nan)
+    acceleration = np.full(len(ids), np.nan)
+    curvature = np.full(len(ids), np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dt = np.diff(t)
+        speed[1:] = np.where(dt > 0, displacement[1:] / dt, np.nan)
+        acceleration[2:] = 2 * np.diff(speed)[1:] / (t[2:] - t[:-2])
+        turn = (np.diff(heading)[1:] + np.pi) % (2 * np.pi) - np.pi
+        curvature[2:] = turn / ((displacement[2:] + displacement[1:-1]) / 2)
+    acceleration[~np.isfinite(acceleration)] = np.nan
+    curvature[~np.isfinite(curvature)] = np.nan
+    return {"displacement":displacement,
+            "heading":np.degrees(heading) % 360,
+            "ground_speed":speed, "acceleration":acceleration,
+            "curvature":curvature, "age":(t - deployed) / 86400}
+
+def iter_kinematics(chunks):
+    """Add kinematics to a stream of chunks sorted by id and time
+
+    The last fixes and the deployment time of a drifter continuing into
+    the next chunk are carried over, so the result equals kinematics() of
+    the concatenated chunks. Row filters in the stream leave gaps that are
+    treated as single steps.
+
+    Example:
+        for df in gdp.iter_kinematics(gdp.iter_chunks(columns=cols)):
+            ...
+    """
+    tail, t0 = None, None
+    for df in chunks:
+        if len(df) == 0:
+            continue
+        carried = 0
+        if tail is not None and tail["id"].iloc[-1] == df["id"].iloc[0]:
+            carried = len(tail)
+            df = pd.concat([tail, df])
+        else:
+            t0 = None
+        df = kinematics(df, t0=t0)
+        last = df["id"].iloc[-1]
+        t0 = df.index[-1] - pd.Timedelta(days=df["age"].iloc[-1])
+        tail = df.iloc[-2:]
+        tail = tail[tail["id"] == last].drop(columns=KINEMATICS)
+        yield df.iloc[carried:]
+
+@instrument.timed("load", name="gdp")
+def load(v1=None, sst=False, vel=False, var=False, workers=None,
+         compact=False, bbox=None, start=None, end=None, columns=None,
+         depth=None):
+    """Load gzipped dat file to a pandas dataframe
+
+    Parameters
+    ----------
+    v1 : int
+        First drifter of the segment to load, all segments if None
+    workers : int
+        Parse the segments concurrently in this many processes. Each
+        process writes its segment to the parquet cache and the parent
+        memory-maps and concatenates the cached tables in one pass.
+    compact : bool
+        Return floats as float32 and the drifter id as a categorical
+    bbox, start, end : tuple, str
+        Positions in (lon1, lat1, lon2, lat2) and times to select
+    columns : list
+        Columns to read, overrides the sst, vel and var flags
+
+    The cache always holds all columns of a segment, the sst, vel, and
+    var flags or columns only decide which columns are read back from it.
+    Rows outside bbox, start and end are skipped while reading the cache.
+    Drifters have no depth column, so depth can not be used. Segments in
+    the active bundle are read from it without download or parsing.
+    """
+    if columns is None:
+        columns = flag_columns(sst=sst, vel=vel, var=var)
+    dnf = filters.build(bbox, start, end, depth)
+    bundled = all(bundle.has(f"buoydata_{v1}") for v1 in SEGMENTS)
+    if v1 is None and workers is not None and workers > 1 and not bundled:
+        df = _load_parallel(workers, columns, dnf, compact=compact)
+    elif v1 is None:
+        df = pd.concat([_load_segment(v1, columns, dnf, compact=compact)
+                        for v1 in SEGMENTS])
+    else:
+        df = _load_segment(v1, columns, dnf, compact=compact)
+    if compact and "id" in df:
+        df["id"] = df["id"].astype("category")
     return df
 
-def vprint(text):
-    pass
-    #print(text)
+def _load_segment(v1, columns, dnf=None, compact=False):
+    if bundle.has(f"buoydata_{v1}"):
+        df = bundle.read(f"buoydata_{v1}", columns=columns, filters=dnf)
+    else:
+        df = cache.cached(f"buoydata_{v1}", fetch_segment(v1), read_dat,
+                          version=CACHE_VERSION, kwargs=ALLCOLUMNS,
+                          columns=columns, filters=dnf)
+    return cache.compact(df) if compact else df
+
+def _cache_segment(v1, filename, columns, cachedir, dnf=None):
+    """Parse segment into the cache, return its path or the dataframe"""
+    name = f"buoydata_{v1}"
+    fn = cache.generate(name, filename, read_dat, version=CACHE_VERSION,
+                        kwargs=ALLCOLUMNS, cachedir=cachedir)
+    if fn is not None:
+        return fn
+    return filters.apply(read_dat(filename, **ALLCOLUMNS), dnf, columns)
+
+def _load_parallel(workers, columns, dnf=None, compact=False):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    filenames = [fetch_segment(v1) for v1 in SEGMENTS]
+    with ProcessPoolExecutor(min(workers, len(SEGMENTS)),
+                             initializer=store.set_root,
+                             initargs=(store.ROOT,)) as pool:
+        parts = list(pool.map(_cache_segment, SEGMENTS, filenames,
+                              [columns] * len(SEGMENTS),
+                              [cache.CACHEDIR] * len(SEGMENTS),
+                              [dnf] * len(SEGMENTS)))
+    if any(isinstance(part, pd.DataFrame) for part in parts):
+        df = pd.concat([part if isinstance(part, pd.DataFrame) else
+                        cache.read(part, columns=columns, filters=dnf)
+                        for part in parts])
+        return cache.compact(df) if compact else df
+    tables = [pq.read_table(fn, columns=columns, memory_map=True,
+                            filters=filters.resolve(dnf, pq.read_schema(fn)),
+                            use_pandas_metadata=True) for fn in parts]
+    table = pa.concat_tables(tables)
+    if not compact:
+        return table.to_pandas()
+    table = table.cast(pa.schema(
+        [field.with_type(pa.float32()) if field.type == pa.float64()
+         else field for field in table.schema], table.schema.metadata))
+    return cache.compact(table.to_pandas())
+
+class TrajectoryStore:
+    """Memory-mapped ragged array store of drifter trajectories
+
+    Each column is kept as one contiguous binary file with all positions
+    of a drifter in consecutive rows, sorted by time. The sorted ids
+    together with the start row and number of rows of every drifter make
+    up the index, so a trajectory is a zero-copy slice of the memory maps.
+    """
+    def __init__(self, trajdir=None):
+        self.trajdir = TRAJDIR if trajdir is None else trajdir
+        with open(os.path.join(self.trajdir, "meta.json")) as fH:
+            self.meta = json.load(fH)
+        self.ids = np.load(os.path.join(self.trajdir, "ids.npy"))
+        self.starts = np.load(os.path.join(self.trajdir, "starts.npy"))
+        self.counts = np.load(os.path.join(self.trajdir, "counts.npy"))
+        self.arrays = {key: np.memmap(os.path.join(self.trajdir, f"{key}.bin"),
+                                      dtype=dtype, mode="r",
+                                      shape=(self.meta["nrows"],)
+                                      ).view(np.ndarray)
+                       for key, dtype in self.meta["dtypes"].items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for id in self.ids:
+            yield id, self.trajectory(id)
+
+    def slice(self, id):
+        """Return the rows of drifter id as a slice"""
+        pos = np.searchsorted(self.ids, id)
+        if pos == len(self.ids) or self.ids[pos] != id:
+            raise KeyError(f"Drifter {id} is not in the trajectory store")
+        return slice(self.starts[pos], self.starts[pos] + self.counts[pos])
+
+    def trajectory(self, id, columns=None):
+        """Return trajectory of one drifter as a dataframe"""
+        sl = self.slice(id)
+        columns = COLUMNS if columns is None else columns
+        index = pd.DatetimeIndex(self.arrays["time"][sl].view("M8[ns]"))
+        return pd.DataFrame({key: self.arrays[key][sl] for key in columns},
+                            index=index, copy=False)
+
+    def trajectories(self, ids, columns=None):
+        """Return trajectories of several drifters as one dataframe"""
+        return pd.concat([self.trajectory(id, columns=columns) for id in ids])
+
+    def query(self, bbox=None, start=None, end=None, columns=None):
+        """Return all positions inside bbox between start and end
+
+        Only the rows in the index blocks overlapping the query are read,
+        so the cost scales with the size of the result rather than the
+        size of the archive. The result is sorted by drifter id and time.
+        """
+        with store.lock("gdp_trajectories"):
+            if not os.path.isfile(os.path.join(self.trajdir, "index.json")):
+                build_index(self.trajdir)
+        rows = query_rows(self.trajdir, bbox=bbox, start=start, end=end)
+        lon, lat = self.arrays["lon"][rows], self.arrays["lat"][rows]
+        time = self.arrays["time"][rows].view("M8[ns]")
+        mask = np.ones(len(rows), dtype=bool)
+        if bbox is not None:
+            mask &= filters.bbox_mask(lon, lat, bbox)
+        if start is not None:
+            mask &= time >= np.datetime64(pd.Timestamp(start), "ns")
+        if end is not None:
+            mask &= time <= np.datetime64(pd.Timestamp(end), "ns")
+        rows = rows[mask]
+        columns = COLUMNS if columns is None else columns
+        return pd.DataFrame({key: self.arrays[key][rows] for key in columns},
+                            index=pd.DatetimeIndex(time[mask]))
+
+def _block_keys(lon, lat, tbin, res):
+    """Return index block of lon/lat grid cell and monthly time bin"""
+    nlon, nlat = int(np.ceil(360 / res)), int(np.ceil(180 / res))
+    ilon = np.clip((np.nan_to_num(lon) + 180) // res, 0, nlon - 1)
+    ilat = np.clip((np.nan_to_num(lat) + 90) // res, 0, nlat - 1)
+    return (tbin * nlat + ilat.astype(np.int64)) * nlon + ilon.astype(np.int64)
+
+def build_index(trajdir=None, res=INDEXRES):
+    """Build spatio-temporal block index of a trajectory store
+
+    Rows are grouped in blocks of res x res degree grid cells and calendar
+    months. The row numbers sorted by block are stored together with the
+    unique block keys and the position where each block starts.
+    """
+    trajs = TrajectoryStore(trajdir)
+    tbin = trajs.arrays["time"].view("M8[ns]").astype("M8[M]").astype(np.int64)
+    keys = _block_keys(trajs.arrays["lon"], trajs.arrays["lat"], tbin, res)
+    order = np.argsort(keys, kind="stable")
+    blocks, starts = np.unique(keys[order], return_index=True)
+    np.save(os.path.join(trajs.trajdir, "index_rows.npy"), order)
+    np.save(os.path.join(trajs.trajdir, "index_blocks.npy"), blocks)
+    np.save(os.path.join(trajs.trajdir, "index_starts.npy"),
+            np.append(starts, len(order)))
+    with open(os.path.join(trajs.trajdir, "index.json"), "w") as fH:
+        json.dump({"res":res, "tmin":int(tbin.min(initial=0)),
+                   "tmax":int(tbin.max(initial=0))}, fH)
+
+def query_rows(trajdir, bbox=None, start=None, end=None):
+    """Return sorted row numbers of all index blocks overlapping a query"""
+    with open(os.path.join(trajdir, "index.json")) as fH:
+        meta = json.load(fH)
+    res = meta["res"]
+    nlon, nlat = int(np.ceil(360 / res)), int(np.ceil(180 / res))
+    rows = np.load(os.path.join(trajdir, "index_rows.npy"), mmap_mode="r")
+    blocks = np.load(os.path.join(trajdir, "index_blocks.npy"))
+    starts = np.load(os.path.join(trajdir, "index_starts.npy"))
+    tmin = meta["tmin"] if start is None else max(meta["tmin"],
+        int(np.datetime64(pd.Timestamp(start), "M").astype(np.int64)))
+    tmax = meta["tmax"] if end is None else min(meta["tmax"],
+        int(np.datetime64(pd.Timestamp(end), "M").astype(np.int64)))
+    if bbox is None:
+        ilon, ilat = np.arange(nlon), np.arange(nlat)
+    else:
+        lon1, lat1, lon2, lat2 = bbox
+        cell = lambda val, offset, n: int(np.clip((val + offset) // res, 0, n-1))
+        ilat = np.arange(cell(lat1, 90, nlat), cell(lat2, 90, nlat) + 1)
+        if lon1 <= lon2:
+            ilon = np.arange(cell(lon1, 180, nlon), cell(lon2, 180, nlon) + 1)
+        else:
+            ilon = np.r_[cell(lon1, 180, nlon):nlon, 0:cell(lon2, 180, nlon)+1]
+    tbin, ilat, ilon = np.meshgrid(np.arange(tmin, tmax + 1), ilat, ilon,
+                                   indexing="ij")
+    keys = ((tbin * nlat + ilat) * nlon + ilon).ravel()
+    pos = np.searchsorted(blocks, keys)
+    found = pos < len(blocks)
+    found[found] = blocks[pos[found]] == keys[found]
+    pos = pos[found]
+    if len(pos) == 0:
+        return np.array([], dtype=np.int64)
+    return np.sort(np.concatenate([rows[starts[p]:starts[p+1]] for p in pos]))
+
+def query(bbox=None, start=None, end=None, columns=None, trajdir=None):
+    """Return all drifter positions inside bbox between start and end"""
+    return open_trajectories(trajdir).query(bbox=bbox, start=start, end=end,
+                                            columns=columns)
+
+def build_trajectories(filenames=None, trajdir=None):
+    """Build memory-mapped trajectory store from the GDP dat files
+
+    The files are processed one at a time, so only one segment is held in
+    memory while the store is written. Drifter ids are assumed not to be
+    split over several files. The spatio-temporal index used by query()
+    is built at the end and stored in the same directory.
+    """
+    trajdir = TRAJDIR if trajdir is None else trajdir
+    tmpdir = store.tmpname(trajdir)
+    os.makedirs(tmpdir, exist_ok=True)
+    dtypes = {}
+    ids, starts, counts = [], [], []
+    nrows = 0
+    for fn in (list(SEGMENTS) if filenames is None else filenames):
+        if filenames is None:
+            df = load(fn, **ALLCOLUMNS)
+        else:
+            df = read_dat(fn, **ALLCOLUMNS)
+        time = df.index.values.astype("M8[ns]").view(np.int64)
+        order = np.lexsort((time, df["id"].values))
+        arrays = {key: df[key].values[order] for key in COLUMNS}
+        arrays["time"] = time[order]
+        for key, values in arrays.items():
+            dtypes[key] = values.dtype.str
+            with open(os.path.join(tmpdir, f"{key}.bin"), "ab") as fH:
+                fH.write(np.ascontiguousarray(values).tobytes())
+        segids, segstarts, segcounts = np.unique(
+            arrays["id"], return_index=True, return_counts=True)
+        ids.append(segids)
+        starts.append(segstarts + nrows)
+        counts.append(segcounts)
+        nrows += len(df)
+    ids, starts, counts = [np.concatenate(arr) for arr in (ids, starts, counts)]
+    order = np.argsort(ids, kind="stable")
+    np.save(os.path.join(tmpdir, "ids.npy"), ids[order])
+    np.save(os.path.join(tmpdir, "starts.npy"), starts[order])
+    np.save(os.path.join(tmpdir, "counts.npy"), counts[order])
+    with open(os.path.join(tmpdir, "meta.json"), "w") as fH:
+        json.dump({"nrows":nrows, "dtypes":dtypes}, fH)
+    build_index(tmpdir)
+    _stores.pop(trajdir, None)
+    if os.path.isdir(trajdir):
+        shutil.rmtree(trajdir)
+    os.replace(tmpdir, trajdir)
+    return trajdir
+
+_stores = {}
+
+def open_trajectories(trajdir=None):
+    """Return trajectory store, build it from the dat files if missing
+
+    Open stores are memoized on the mtime of their meta.json, so a store
+    rebuilt by another process is reopened instead of serving the memory
+    maps of the removed files.
+    """
+    trajdir = TRAJDIR if trajdir is None else trajdir
+    metafn = os.path.join(trajdir, "meta.json")
+    if not os.path.isfile(metafn):
+        with store.lock("gdp_trajectories"):
+            if not os.path.isfile(metafn):
+                build_trajectories(trajdir=trajdir)
+    mtime = os.stat(metafn).st_mtime_ns
+    if trajdir not in _stores or _stores[trajdir][0] != mtime:
+        _stores[trajdir] = (mtime, TrajectoryStore(trajdir))
+    return _stores[trajdir][1]
+
+def trajectory(id, columns=None, trajdir=None):
+    """Return the trajectory of one drifter"""
+    return open_trajectories(trajdir).trajectory(id, columns=columns)
+
+def trajectories(ids, columns=None, trajdir=None):
+    """Return the trajectories of several drifters as one dataframe"""
+    return open_trajectories(trajdir).trajectories(ids, columns=columns)
+
+def iter_trajectories(trajdir=None):
+    """Iterate over (id, dataframe) for all drifters"""
+    return iter(open_trajectories(trajdir))
 
 def open_ftp_session(url="ftp://ftp.aoml.noaa.gov/phod/pub/buoydata/"):
     spliturl = urlsplit(url)
     try:
         ftp = ftplib.FTP(spliturl.netloc) 
-        vprint(ftp.login("anonymous", "oceandata@bror.us"))
+        instrument.logger.debug(ftp.login("anonymous", "oceandata@bror.us"))
         ftpdir = spliturl.path
-        vprint("Change dir to '%s'" % ftpdir)
-        vprint(ftp.cwd(ftpdir))
+        instrument.logger.debug("Change dir to '%s'" % ftpdir)
+        instrument.logger.debug(ftp.cwd(ftpdir))
     except ftplib.error_perm as err:
         print (spliturl.netloc)
         print (os.path.split(spliturl.path)[0])
@@ -89,27 +567,32 @@ def server_file_list(url="ftp://ftp.aoml.noaa.gov/phod/pub/buoydata/", ftp=None)
 
 def download(url="ftp://ftp.aoml.noaa.gov/phod/pub/buoydata/", v1=1, v2=5000):
     """Download tsv file from NOOA's website using ftp"""
+    import click
     lfn = filename = f"buoydata_{v1}_{v2}.dat.gz"
+    os.makedirs(DATADIR, exist_ok=True)
     ftp = open_ftp_session(url=url)
 
     local_filename = os.path.join(DATADIR, filename)
+    tmpfn = store.tmpname(local_filename)
     if not filename in ftp.nlst():
         print(ftp.nlst())
         raise ftplib.Error("'%s' is not the ftp server" % lfn)
-    with open(local_filename, 'wb') as lfh:
+    with open(tmpfn, 'wb') as lfh:
         ftp.voidcmd('TYPE I')
         length = ftp.size(lfn)
         short_lfn = lfn if len(lfn)<18 else lfn[:4] + "..." + lfn[-13:]
-        with click.progressbar(length=length, label=short_lfn) as bar:
+        with click.progressbar(length=length, label=short_lfn) as bar, \
+             instrument.stage("download", name=lfn, bytes=length):
             def file_write(data):
                 lfh.write(data) 
                 bar.update(len(data))
             try:
                 ftp.retrbinary("RETR %s" % lfn, file_write)
             except ftplib.error_perm as err:
-                os.unlink(local_filename)
+                os.unlink(tmpfn)
                 raise IOError(err)
         ftp.quit()
+    os.replace(tmpfn, local_filename)
 
 def unzip(filename="SOCATv6.tsv.zip"):
     local_filename = os.path.join(DATADIR, filename)
@@ -0,0 +1,171 @@
+"""Per-stage timing of downloads, parsing and cache access
+
+Loaders, the downloader and the cache wrap each stage of their work, such
+as a download, a csv parse, the datetime conversion or a cache write, in
+stage(). When the stage ends an event is passed to every subscribed
+callback. Events are dicts with the keys
+
+    stage     name of the stage, e.g. 'download', 'parse' or 'cache_write'
+    name      dataset, file or url the stage worked on
+    duration  wall time in seconds
+    bytes     bytes read, written or downloaded, None if not known
+    rows      rows produced, None if not known
+    parent    'stage:name' of the enclosing stage in the same thread
+    error     exception class name if the stage failed, else None
+
+Nothing is recorded unless a callback is subscribed. Stages in worker
+processes, as in gdp.load(workers=n), are not seen by the parent.
+
+Example:
+    with instrument.collect() as stats:
+        df = mapps.load()
+    print(stats.summary())
+
+    instrument.enable_logging()
+    instrument.subscribe(lambda event: metrics.send(**event))
+
+"""
+import time
+import logging
+import functools
+import threading
+import contextlib
+
+logger = logging.getLogger("oceandata")
+
+_callbacks = []
+_local = threading.local()
+
+
+class Stage:
+    """Record of a running stage, set bytes and rows while it runs"""
+    def __init__(self, stage, name=None, bytes=None, rows=None):
+        self.stage = stage
+        self.name = name
+        self.bytes = bytes
+        self.rows = rows
+
+
+def subscribe(callback):
+    """Call callback(event) at the end of every stage"""
+    if callback not in _callbacks:
+        _callbacks.append(callback)
+    return callback
+
+
+def unsubscribe(callback):
+    if callback in _callbacks:
+        _callbacks.remove(callback)
+
+
+@contextlib.contextmanager
+def stage(stage, name=None, bytes=None, rows=None):
+    """Time a stage of work and emit an event when it ends
+
+    Example:
+        with instrument.stage("parse", name=fn) as st:
+            df = pd.read_csv(fn)
+            st.rows = len(df)
+    """
+    rec = Stage(stage, name=name, bytes=bytes, rows=rows)
+    if not _callbacks:
+        yield rec
+        return
+    stack = _local.__dict__.setdefault("stack", [])
+    parent = f"{stack[-1].stage}:{stack[-1].name}" if stack else None
+    stack.append(rec)
+    error = None
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    except BaseException as err:
+        error = type(err).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - t0
+        stack.pop()
+        emit({"stage":stage, "name":name, "duration":duration,
+              "bytes":rec.bytes, "rows":rec.rows, "parent":parent,
+              "error":error})
+
+
+def emit(event):
+    """Pass an event to all callbacks"""
+    for callback in list(_callbacks):
+        callback(event)
+
+
+def timed(stage_name, name=None):
+    """Decorate a function returning a dataframe to run as a stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, name=name or func.__name__) as rec:
+                df = func(*args, **kwargs)
+                rec.rows = len(df)
+            return df
+        return wrapper
+    return decorator
+
+
+class Stats:
+    """In-memory collector of stage events"""
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+
+    def summary(self):
+        """Return count, time, bytes, rows and throughput per stage"""
+        import pandas as pd
+        columns = ["stage", "name", "duration", "bytes", "rows"]
+        df = pd.DataFrame(list(self.events), columns=columns)
+        summary = df.groupby("stage").agg(
+            count=("duration", "size"), duration=("duration", "sum"),
+            bytes=("bytes", "sum"), rows=("rows", "sum"))
+        summary["mb_per_s"] = summary["bytes"] / 2**20 / summary["duration"]
+        summary["rows_per_s"] = summary["rows"] / summary["duration"]
+        return summary.sort_values("duration", ascending=False)
+
+
+@contextlib.contextmanager
+def collect():
+    """Collect the events of all stages run inside the block"""
+    stats = Stats()
+    subscribe(stats)
+    try:
+        yield stats
+    finally:
+        unsubscribe(stats)
+
+
+def log_event(event):
+    """Log an event on the oceandata logger"""
+    parts = [f"{event['stage']}", f"{event['name'] or ''}",
+             f"{event['duration']:.3f} s"]
+    if event["bytes"] is not None:
+        parts.append(f"{event['bytes'] / 2**20:.1f} MB")
+    if event["rows"] is not None:
+        parts.append(f"{event['rows']} rows")
+    if event["error"] is not None:
+        parts.append(f"failed with {event['error']}")
+    logger.info(" ".join(parts))
+
+
+def enable_logging(level=logging.INFO):
+    """Log every stage on the oceandata logger, set up a handler if needed"""
+    if not logger.handlers and not logging.getLogger().handlers:
+        logging.basicConfig(format="%(asctime)s %(name)s %(message)s")
+    logger.setLevel(level)
+    subscribe(log_event)
+
+
+def disable_logging():
+    unsubscribe(log_event)
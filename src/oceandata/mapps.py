@@ -17,15 +17,49 @@ import pathlib
 import numpy as np
 import pandas as pd
 
-import requests
 
-DATADIR = os.path.expanduser("~/.oceandata/")
+from . import bundle, cache, downloader, filters, instrument, pangaea, store
+
+DATADIR = store.path()
 FILENAME = "Bouman_2017.tab.tsv"
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+PMLFILENAME = "GLOBAL_PE_W_LOV_2019.csv"
+CACHE_VERSION = 1
+
+@instrument.timed("load", name="mapps")
+def load(filename=None, compact=False,
+         bbox=None, start=None, end=None, columns=None, depth=None):
+    """Load tsv file and fix some columns
+
+    Parameters
+    ----------
+    bbox : tuple
+        (lon1, lat1, lon2, lat2) box to select positions in
+    start, end : str or Timestamp
+        Inclusive time range to select
+    columns : list
+        Columns to read
+    depth : float or tuple
+        Maximum depth, or (min, max) depth range
+    compact : bool
+        Return floats as float32 and region as a categorical
+
+    Rows and columns are selected while the parquet cache is read, so the
+    rest of the dataset is never materialised. The dataset is read from
+    the active bundle when it holds one, unless filename is given.
+    """
+    dnf = filters.build(bbox, start, end, depth)
+    if filename is None and bundle.has("mapps"):
+        df = bundle.read("mapps", columns=columns, filters=dnf)
+    else:
+        filename = FILENAME if filename is None else filename
+        fn = os.path.join(DATADIR, filename)
+        df = cache.cached("mapps", fn, read_tab, version=CACHE_VERSION,
+                          columns=columns, filters=dnf)
+    return cache.compact(df, categories=["region"]) if compact else df
 
-def load(filename=FILENAME):
-    """Load tsv file and fix some columns"""
-    df = pd.read_csv(os.path.join(DATADIR, FILENAME), sep="\t", skiprows=57)
+def read_tab(filename):
+    """Read Pangaea tsv file and clean columns"""
+    df = pangaea.read_tab(filename)
     df["lat"]    = df["Latitude"]
     df["lon"]    = df["Longitude"]
     df["region"] = df["BG province"]
@@ -48,23 +82,7 @@ def download(url="https://doi.pangaea.de/10.1594/PANGAEA.874087",
     """Download tsv file from Pangaea server"""
     filename = FILENAME if filename is None else filename
     local_filename = os.path.join(DATADIR, filename)
-    try:
-        r = requests.get(url, params=params, stream=True, timeout=2)
-    except requests.ReadTimeout:
-        warnings.warn("Connection to server timed out.")
-        return False
-    if r.ok:
-        if local_filename is None:
-            return r.text
-        else:
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024): 
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-            return None
-    else:
-        raise IOError("Could not download file from server")
+    return downloader.fetch(url, local_filename, params=params, timeout=2)
 
 
 def download_pml(url="https://github.com/brorfred/oceandata/raw/master/data/",
@@ -73,9 +91,27 @@ def download_pml(url="https://github.com/brorfred/oceandata/raw/master/data/",
     download(url=f"{url}/{filename}", filename=filename, params=params)
 
 
-def load_pml(filename="GLOBAL_PE_W_LOV_2019.csv"):
-    fn = os.path.join(DATADIR, filename)
-    df = pd.read_csv(fn, parse_dates=[[4,5,6]], index_col="YEAR_MONTH_DAY")
+@instrument.timed("load", name="mapps_pml")
+def load_pml(filename=None, compact=False,
+             bbox=None, start=None, end=None, columns=None, depth=None):
+    """Load local PML version of MAPPS, arguments as in load"""
+    dnf = filters.build(bbox, start, end, depth)
+    if filename is None and bundle.has("mapps_pml"):
+        df = bundle.read("mapps_pml", columns=columns, filters=dnf)
+    else:
+        filename = PMLFILENAME if filename is None else filename
+        fn = os.path.join(DATADIR, filename)
+        df = cache.cached("mapps_pml", fn, read_pml, version=CACHE_VERSION,
+                          columns=columns, filters=dnf)
+    return cache.compact(df, categories=["region"]) if compact else df
+
+def read_pml(filename):
+    """Read PML csv file and rename columns"""
+    df = pd.read_csv(filename)
+    df.set_index(pd.DatetimeIndex(
+        pd.to_datetime(df[["YEAR", "MONTH", "DAY"]]), name="YEAR_MONTH_DAY"),
+        inplace=True)
+    df.drop(columns=["YEAR", "MONTH", "DAY"], inplace=True)
     df = df.rename(columns={"LAT":"lat", "LON":"lon", "DEPTH":"depth",
                             "TEMP":"temp", "TCHL":"chl", "ALPHA":"alpha",
                             'NITRATE':"NO3",'SILICATE':"Si4",'PHOSPHATE':"PO4",
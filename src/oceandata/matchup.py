@@ -0,0 +1,191 @@
+"""Match point observations with local gridded products
+
+Observations given as lon, lat, time vectors are grouped by the time
+slice of the product they fall in. For every slice a single block
+covering all points of that slice is read, and values are sampled from it
+with vectorised n x n neighbourhood means. The field can be anything that
+supports basic [time, lat, lon] slicing and only reads what is sliced:
+numpy arrays and memmaps, netCDF4 or zarr variables, or lazily opened
+xarray DataArrays.
+
+Example:
+    da = matchup.open_field("chl_2003.nc", "chl")
+    df["chl"] = matchup.match(da, df.lon, df.lat, df.index, nei=3)
+
+"""
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+def open_field(filename, var, chunks={}):
+    """Open variable in a NetCDF file or Zarr store lazily with xarray"""
+    import xarray as xr
+    filename = str(filename)
+    if filename.endswith(".zarr") or os.path.isdir(filename):
+        ds = xr.open_zarr(filename)
+    else:
+        ds = xr.open_dataset(filename, chunks=chunks)
+    return ds[var]
+
+
+def grid_index(coord, values):
+    """Return index of nearest grid cell, -1 outside the grid
+
+    coord is a 1D monotonic vector of cell centers.
+    """
+    coord = np.asarray(coord, dtype=float)
+    values = np.asarray(values, dtype=float)
+    flip = len(coord) > 1 and coord[0] > coord[-1]
+    if flip:
+        coord = coord[::-1]
+    pos = np.clip(np.searchsorted(coord, values), 1, max(len(coord) - 1, 1))
+    left = coord[pos - 1]
+    right = coord[np.minimum(pos, len(coord) - 1)]
+    idx = np.where(np.abs(values - left) <= np.abs(right - values), pos - 1, pos)
+    idx = np.minimum(idx, len(coord) - 1)
+    half = np.abs(np.diff(coord)).max() / 2 if len(coord) > 1 else np.inf
+    outside = ~(np.abs(coord[idx] - values) <= half)
+    if flip:
+        idx = len(coord) - 1 - idx
+    return np.where(outside, -1, idx)
+
+
+def time_index(gridtime, time, maxdt=None):
+    """Return index of nearest time slice, -1 if further away than maxdt"""
+    gridtime = np.asarray(gridtime, dtype="M8[ns]").astype(np.int64)
+    time = np.asarray(pd.DatetimeIndex(time), dtype="M8[ns]").astype(np.int64)
+    pos = np.clip(np.searchsorted(gridtime, time), 1, max(len(gridtime)-1, 1))
+    left = gridtime[pos - 1]
+    right = gridtime[np.minimum(pos, len(gridtime) - 1)]
+    idx = np.where(np.abs(time - left) <= np.abs(right - time), pos - 1, pos)
+    idx = np.minimum(idx, len(gridtime) - 1)
+    if maxdt is not None:
+        maxdt = pd.Timedelta(maxdt).value
+        idx[np.abs(gridtime[idx] - time) > maxdt] = -1
+    return idx
+
+
+def sample(read, iy, ix, shape, nei=1, periodic=False):
+    """Return n x n neighbourhood means around grid cells (iy, ix)
+
+    read is called once as read(yslice, xslice) to get the block of the
+    field covering all cells and their neighbours.
+    """
+    ny, nx = shape
+    result = np.full(len(iy), np.nan)
+    inside = (iy >= 0) & (ix >= 0)
+    if not inside.any():
+        return result
+    offsets = np.arange(nei) - nei // 2
+    yy = iy[inside, None, None] + offsets[None, :, None]
+    xx = ix[inside, None, None] + offsets[None, None, :]
+    yy, xx = np.broadcast_arrays(yy, xx)
+    valid = (yy >= 0) & (yy < ny)
+    if periodic:
+        xx = xx % nx
+    else:
+        valid &= (xx >= 0) & (xx < nx)
+    y0, y1 = yy[valid].min(), yy[valid].max() + 1
+    x0, x1 = xx[valid].min(), xx[valid].max() + 1
+    block = np.ma.filled(np.ma.asarray(
+        read(slice(y0, y1), slice(x0, x1)), dtype=float), np.nan)
+    values = np.full(yy.shape, np.nan)
+    values[valid] = block[yy[valid] - y0, xx[valid] - x0]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        result[inside] = np.nanmean(values.reshape(len(values), -1), axis=1)
+    return result
+
+
+def _coords(field, gridlon, gridlat, gridtime):
+    coords = getattr(field, "coords", {})
+    def coord(value, names):
+        if value is not None:
+            return np.asarray(value)
+        for name in names:
+            if name in coords:
+                return np.asarray(coords[name].values)
+        raise ValueError(f"Field has no {names[0]} coordinate")
+    gridlon = coord(gridlon, ["lon", "longitude"])
+    gridlat = coord(gridlat, ["lat", "latitude"])
+    if np.ndim(field) == 3:
+        gridtime = coord(gridtime, ["time"])
+    return gridlon, gridlat, gridtime
+
+
+def _periodic(gridlon):
+    if len(gridlon) < 2:
+        return False
+    step = np.abs(np.diff(gridlon)).mean()
+    return np.abs(np.abs(gridlon[-1] - gridlon[0]) + step - 360) < step / 2
+
+
+def _wrap(lon, gridlon):
+    """Shift lon to the longitude convention of the grid"""
+    lon = np.asarray(lon, dtype=float)
+    if np.nanmax(gridlon) > 180:
+        return lon % 360
+    return (lon + 180) % 360 - 180
+
+
+def match(field, lon, lat, time=None, nei=1, maxdt=None,
+          gridlon=None, gridlat=None, gridtime=None):
+    """Sample a gridded field at point observations
+
+    Parameters
+    ----------
+    field : array-like
+        (time, lat, lon) or (lat, lon) field supporting basic slicing
+    lon, lat, time : array-like
+        Positions and times of the observations
+    nei : int
+        Width of the n x n neighbourhood averaged around each point
+    maxdt : str or Timedelta
+        Points further than this from the nearest time slice get NaN
+    gridlon, gridlat, gridtime : array-like
+        Grid coordinates, taken from field.coords if not given
+
+    Returns an array with one value per observation.
+    """
+    gridlon, gridlat, gridtime = _coords(field, gridlon, gridlat, gridtime)
+    ix = grid_index(gridlon, _wrap(lon, gridlon))
+    iy = grid_index(gridlat, lat)
+    shape = (len(gridlat), len(gridlon))
+    periodic = _periodic(gridlon)
+    if np.ndim(field) == 2:
+        return sample(lambda ys, xs: field[ys, xs], iy, ix, shape,
+                      nei=nei, periodic=periodic)
+    it = time_index(gridtime, time, maxdt=maxdt)
+    result = np.full(len(it), np.nan)
+    for t in np.unique(it[it >= 0]):
+        mask = it == t
+        result[mask] = sample(lambda ys, xs: field[t, ys, xs],
+                              iy[mask], ix[mask], shape,
+                              nei=nei, periodic=periodic)
+    return result
+
+
+def match_files(filenames, var, lon, lat, time, nei=1, freq="D",
+                opener=open_field):
+    """Match observations with one product file per time period
+
+    filenames is called with the start of each period (a Timestamp) that
+    has observations and returns the file covering it, or None if there
+    is none. Each file is opened once and read once.
+    """
+    periods = pd.DatetimeIndex(time).floor(freq)
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    result = np.full(len(periods), np.nan)
+    for period in periods.dropna().unique():
+        filename = filenames(period)
+        if filename is None or not os.path.exists(filename):
+            continue
+        field = opener(filename, var)
+        mask = np.asarray(periods == period)
+        if np.ndim(field) == 3:
+            field = field[0]
+        result[mask] = match(field, lon[mask], lat[mask], nei=nei)
+    return result
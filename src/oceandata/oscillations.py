@@ -1,25 +1,172 @@
+"""Monthly climate indices in NOAA PSL format
+
+PSL files start with a line holding the first and last year, followed by
+one row per year with twelve monthly values and a footer whose first line
+is the missing value. Every index in INDICES is downloaded once to
+DATADIR, refreshed with a conditional request when older than MAXAGE
+seconds, and kept parsed in memory so repeated calls are nearly free.
+
+Example:
+    df = oscillations.load("enso")
+
+"""
+import io
+import os
+import time
+import warnings
 
 import numpy as np
 import pandas as pd
 
-def read_psl(dataurl, skipfooter=4):
-    df = pd.read_csv(dataurl, sep=" ", na_values=-999.0,
-                     skiprows=1, skipfooter=skipfooter, 
-                     index_col="year", skipinitialspace=True,
-                     names=["year",1,2,3,4,5,6,7,8,9,10,11,12],
-                     engine='python')
-    df = df.unstack().reset_index(level=[0,1]).set_index("year").rename(
-        columns={"level_0":"month", 0:"value"})
-    df = df.sort_values(by=["year","month"]) 
-    dtm = [pd.to_datetime(f"{year}-{month}-01")for year, month in zip(df.index,df.month)]
-    return df.set_index(pd.DatetimeIndex(dtm))
+from . import bundle, downloader, instrument, store
+
+DATADIR = store.path("indices")
+MAXAGE = 7 * 24 * 3600
+INDICES = {
+    "enso": "https://psl.noaa.gov/enso/mei/data/meiv2.data",
+    "iod":  "https://psl.noaa.gov/gcos_wgsp/Timeseries/Data/dmi.had.long.data",
+    "nao":  "https://psl.noaa.gov/data/correlation/nao.data",
+    "pdo":  "https://psl.noaa.gov/data/correlation/pdo.data",
+    "soi":  "https://psl.noaa.gov/data/correlation/soi.data",
+    "oni":  "https://psl.noaa.gov/data/correlation/oni.data",
+    "amo":  "https://psl.noaa.gov/data/correlation/amon.us.data",
+}
+
+_memo = {}
+
+
+def register(name, url):
+    """Add a PSL formatted index to the registry"""
+    INDICES[name] = url
+    _memo.pop(name, None)
+
+
+def parse_psl(text):
+    """Parse PSL formatted text to a monthly dataframe"""
+    lines = text.splitlines()
+    year1, year2 = [int(val) for val in lines[0].split()[:2]]
+    nrows = year2 - year1 + 1
+    footer = lines[nrows + 1].split() if len(lines) > nrows + 1 else []
+    na_values = [-999.0]
+    if len(footer) == 1:
+        na_values.append(float(footer[0]))
+    df = pd.read_csv(io.StringIO(text), sep=r"\s+", header=None,
+                     skiprows=1, nrows=nrows, usecols=range(13),
+                     na_values=na_values, engine="c")
+    years = np.repeat(df[0].values.astype(np.int64), 12)
+    months = np.tile(np.arange(1, 13), len(df))
+    dtm = ((years - 1970) * 12 + months - 1).astype("M8[M]").astype("M8[ns]")
+    return pd.DataFrame({"month":months,
+                         "value":df[list(range(1, 13))].values.ravel()},
+                        index=pd.DatetimeIndex(dtm))
+
+
+def read_psl(dataurl, skipfooter=None):
+    """Read PSL formatted index from a local file or url
+
+    skipfooter is deprecated and ignored, the number of data rows is
+    taken from the year range on the first line.
+    """
+    if skipfooter is not None:
+        warnings.warn("skipfooter is deprecated and ignored",
+                      DeprecationWarning, stacklevel=2)
+    if os.path.isfile(dataurl):
+        with open(dataurl) as fH:
+            return parse_psl(fH.read())
+    r = downloader.session().get(dataurl, timeout=downloader.TIMEOUT)
+    r.raise_for_status()
+    return parse_psl(r.text)
+
+
+def fetch(name, maxage=MAXAGE):
+    """Return local file of an index, refresh it if older than maxage"""
+    import requests
+    fn = os.path.join(DATADIR, f"{name}.data")
+    if os.path.isfile(fn) and time.time() - os.path.getmtime(fn) < maxage:
+        return fn
+    with store.lock(f"index_{name}"):
+        if os.path.isfile(fn) and time.time() - os.path.getmtime(fn) < maxage:
+            return fn
+        try:
+            error = None
+            if not downloader.fetch(INDICES[name], fn):
+                error = "the connection timed out"
+        except (IOError, requests.ConnectionError) as err:
+            error = err
+        if error is None and os.path.isfile(fn):
+            os.utime(fn)
+        elif not os.path.isfile(fn):
+            raise IOError(f"Could not download index '{name}' from "
+                          f"{INDICES[name]}: {error}")
+        else:
+            warnings.warn(f"Could not refresh '{name}', using local copy: "
+                          f"{error}")
+    return fn
+
+
+@instrument.timed("load", name="indices")
+def load(name, maxage=MAXAGE):
+    """Return monthly climate index as a dataframe with column name
+
+    The index is read from the active bundle when it holds it.
+    """
+    if bundle.has(f"index_{name}"):
+        return bundle.read(f"index_{name}")
+    fn = fetch(name, maxage=maxage)
+    mtime = os.stat(fn).st_mtime_ns
+    if name not in _memo or _memo[name][0] != mtime:
+        with open(fn) as fH:
+            df = parse_psl(fH.read()).rename(columns={"value":name})
+        _memo[name] = (mtime, df)
+    return _memo[name][1].copy()
+
 
 def read_enso():
-    dataurl = "https://psl.noaa.gov/enso/mei/data/meiv2.data"
-    df = read_psl(dataurl, skipfooter=4)
-    return df.rename(columns={"value":"enso"})
+    return load("enso")
+
 
 def read_iod():
-    dataurl = "https://psl.noaa.gov/gcos_wgsp/Timeseries/Data/dmi.had.long.data"
-    df = read_psl(dataurl, skipfooter=7)
-    return df.rename(columns={"value":"iod"})
+    return load("iod")
+
+
+def annotate(df, indices=["enso", "iod"], lag=0, rolling=None, time=None,
+             inplace=False, maxage=MAXAGE):
+    """Add the concurrent monthly climate index values to observations
+
+    The observation times are converted to calendar months and looked up
+    in each index with one searchsorted call, so annotating n rows with
+    an index of m months is O(n log m).
+
+    Parameters
+    ----------
+    indices : list
+        Names of indices in INDICES
+    lag : int
+        Use the index value this many months before each observation
+    rolling : int
+        Use the trailing mean over this many months of the index
+    time : str
+        Column holding observation times, the index of df if None
+
+    New columns are named after the index, with '_lag{lag}' and
+    '_mean{rolling}' appended when used.
+    """
+    df = df if inplace else df.copy()
+    dtm = df.index if time is None else df[time]
+    obsmonths = np.asarray(dtm, dtype="M8[ns]").astype("M8[M]")
+    obsmonths = obsmonths.astype(np.int64) - lag
+    nat = np.isnat(np.asarray(dtm, dtype="M8[ns]"))
+    for name in indices:
+        ser = load(name, maxage=maxage)[name]
+        if rolling is not None:
+            ser = ser.rolling(rolling, min_periods=rolling).mean()
+        months = ser.index.values.astype("M8[M]").astype(np.int64)
+        pos = np.searchsorted(months, obsmonths)
+        found = (pos < len(months)) & ~nat
+        found[found] = months[pos[found]] == obsmonths[found]
+        values = np.full(len(df), np.nan)
+        values[found] = ser.values[pos[found]]
+        key = name + (f"_lag{lag}" if lag else "")
+        key += f"_mean{rolling}" if rolling else ""
+        df[key] = values
+    return df
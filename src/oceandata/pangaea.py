@@ -0,0 +1,183 @@
+"""Reader for PANGAEA tab separated text files
+
+PANGAEA text files start with a /* ... */ block describing the dataset
+followed by one header line with the column names. The header is parsed
+once per file and cached together with the column names, units and DOI,
+so the metadata is available without reading any data rows. Data are read
+with an explicit dtype map and explicit date columns. Files bundled in a
+zip archive are read straight from the archive by giving the member name.
+
+Example:
+    meta = pangaea.describe("GO_flux.tab")
+    df = pangaea.read_tab("GO_flux.tab")
+    df = pangaea.read_tab("valente_2022.zip", member="datasets/chla.tab")
+
+"""
+import os
+import re
+import json
+import hashlib
+import zipfile
+import warnings
+import contextlib
+
+import pandas as pd
+
+from . import cache, instrument, store
+
+DOIREGEX = re.compile(r"doi\.org/(10\.\d+/[^\s,;]+)")
+UNITREGEX = re.compile(r"\[([^\]]+)\]")
+FLOATNAMES = ["Latitude", "Longitude", "Depth", "Elevation", "Sal", "Temp"]
+HEADERVERSION = 2
+
+_headers = {}
+
+
+@contextlib.contextmanager
+def open_data(filename, member=None):
+    """Open a text file, or a member of a zip archive, for binary reading"""
+    if member is None:
+        with open(filename, "rb") as fH:
+            yield fH
+    else:
+        with zipfile.ZipFile(filename) as zf, zf.open(member) as fH:
+            yield fH
+
+
+def read_header(filename, member=None):
+    """Return metadata in the /* */ header of a PANGAEA text file"""
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    memokey = (filename, member, stat.st_size, stat.st_mtime_ns)
+    if memokey in _headers:
+        return _headers[memokey]
+    key = cache.file_hash(filename)[:16]
+    if member is not None:
+        key += "_" + hashlib.sha1(member.encode()).hexdigest()[:8]
+    jsonfn = os.path.join(cache.CACHEDIR, f"pangaea_{HEADERVERSION}_{key}.json")
+    if os.path.isfile(jsonfn):
+        with open(jsonfn) as fH:
+            header = json.load(fH)
+    else:
+        header = parse_header(filename, member=member)
+        os.makedirs(cache.CACHEDIR, exist_ok=True)
+        tmpfn = store.tmpname(jsonfn)
+        with open(tmpfn, "w") as fH:
+            json.dump(header, fH)
+        os.replace(tmpfn, jsonfn)
+    _headers[memokey] = header
+    return header
+
+
+def parse_header(filename, member=None):
+    """Parse the /* */ header and the column line of a PANGAEA text file"""
+    header = {}
+    key = None
+    offset = 0
+    with open_data(filename, member) as fH:
+        for skiprows, line in enumerate(fH, 1):
+            offset += len(line)
+            line = line.decode("utf-8")
+            if "*/" in line:
+                break
+            line = line.rstrip("\r\n").lstrip("/* ")
+            if line.startswith("\t") and key is not None:
+                header[key].append(line.strip())
+            elif ":\t" in line:
+                key, value = line.split(":\t", 1)
+                header[key] = [value.strip()]
+        else:
+            raise ValueError(f"'{filename}' has no PANGAEA /* */ header")
+        columns = fH.readline().decode("utf-8").rstrip("\r\n").split("\t")
+    meta = {key.strip().lower(): val[0] if len(val) == 1 else val
+            for key, val in header.items() if key.strip()}
+    doi = DOIREGEX.search(" ".join(
+        val if isinstance(val, str) else " ".join(val)
+        for val in meta.values()))
+    meta["doi"] = doi.group(1) if doi else None
+    meta["columns"] = columns
+    meta["units"] = {col: UNITREGEX.search(col).group(1)
+                     for col in columns if UNITREGEX.search(col)}
+    meta["skiprows"] = skiprows
+    meta["offset"] = offset
+    return meta
+
+
+def describe(filename, member=None):
+    """Return dataset metadata without parsing any data rows"""
+    return read_header(filename, member=member)
+
+
+def schema(filename, member=None):
+    """Return column dtypes used when reading a PANGAEA text file
+
+    Columns with units and coordinates are read as floats and Date/Time
+    columns as dates. The dtype of remaining columns is left to pandas.
+    """
+    header = read_header(filename, member=member)
+    dtypes = {}
+    for col in header["columns"]:
+        if col.lower().startswith("date/time"):
+            dtypes[col] = "datetime64[ns]"
+        elif col in header["units"] or col.split(" ")[0] in FLOATNAMES:
+            dtypes[col] = "float64"
+        else:
+            dtypes[col] = "object"
+    return dtypes
+
+
+def read_tab(filename, dtype=None, usecols=None, engine="c", member=None):
+    """Read data rows of a PANGAEA text file to a dataframe
+
+    Parameters
+    ----------
+    dtype : dict
+        Dtypes overriding the ones given by schema()
+    usecols : list
+        Read only these columns
+    engine : str
+        Parser engine passed to pd.read_csv, 'c' or 'pyarrow'
+    member : str
+        Read this member of the zip archive filename, without extracting
+    """
+    header = read_header(filename, member=member)
+    dtypes = schema(filename, member=member)
+    dtypes.update({} if dtype is None else dtype)
+    if usecols is not None:
+        dtypes = {key: val for key, val in dtypes.items() if key in usecols}
+    dates = [key for key, val in dtypes.items() if val.startswith("datetime")]
+    numeric = {key: val for key, val in dtypes.items()
+               if key not in dates and val != "object"}
+    kwargs = dict(sep="\t", usecols=usecols, parse_dates=dates,
+                  engine=engine, encoding="utf-8")
+    with open_data(filename, member) as fH, instrument.stage(
+            "read_csv", name=member or os.path.basename(filename)) as rec:
+        try:
+            fH.seek(header["offset"])
+            df = pd.read_csv(fH, dtype=numeric, **kwargs)
+        except ValueError:
+            fH.seek(header["offset"])
+            df = coerce(pd.read_csv(fH, **kwargs), numeric,
+                        member or filename)
+        rec.bytes, rec.rows = fH.tell() - header["offset"], len(df)
+    return df
+
+
+def coerce(df, dtypes, filename):
+    """Cast columns to dtypes, values that can not be parsed become NaN
+
+    A warning names every column with values that could not be parsed.
+    """
+    for col, dtype in dtypes.items():
+        if col not in df:
+            continue
+        try:
+            df[col] = df[col].astype(dtype)
+        except (ValueError, TypeError):
+            values = pd.to_numeric(df[col], errors="coerce")
+            bad = df[col][values.isna() & df[col].notna()]
+            warnings.warn(f"Column '{col}' in '{filename}' has {len(bad)} "
+                          f"values that are not {dtype}, e.g. "
+                          f"{bad.iloc[0]!r}, read as NaN")
+            df[col] = values.astype(dtype)
+    return df
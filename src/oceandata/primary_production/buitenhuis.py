@@ -34,58 +34,78 @@ import warnings
 
 import numpy as np
 import pandas as pd
-import requests
 from datetime import datetime
 
-DATADIR = pathlib.PurePath(pathlib.Path.home(), ".oceandata")
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+from .. import bundle, cache, downloader, filters, instrument, store
+
+DATADIR = pathlib.PurePath(store.path())
 DATAURL = "http://greenocean-data.uea.ac.uk/biogeochemistry"
+FILENAME = "PP_Buitenhuisetal2013.xls"
+CACHE_VERSION = 1
+COLUMNS = ["Day", "Month", "Year", "LAT", "LONG", "Depth", "PP"]
+
+@instrument.timed("load", name="buitenhuis")
+def load(datadir=None, filename=None, compact=False,
+         bbox=None, start=None, end=None, columns=None, depth=None):
+    """Load excel file and convert to pandas dataframe
+
+    bbox = (lon1, lat1, lon2, lat2), start, end, depth and columns select
+    rows and columns while reading the cache, see filters.build. The
+    dataset is read from the active bundle when it holds one, unless
+    datadir or filename is given.
+    """
+    dnf = filters.build(bbox, start, end, depth)
+    if datadir is None and filename is None and bundle.has("buitenhuis"):
+        df = bundle.read("buitenhuis", columns=columns, filters=dnf)
+    else:
+        datadir = DATADIR if datadir is None else datadir
+        filename = FILENAME if filename is None else filename
+        fn = os.path.join(datadir, filename)
+        with store.lock("buitenhuis"):
+            if not os.path.isfile(fn):
+                download(datadir=datadir, filename=filename)
+        df = cache.cached("buitenhuis", fn, read_xls, version=CACHE_VERSION,
+                          columns=columns, filters=dnf)
+    return cache.compact(df) if compact else df
+
+def read_xls(filename):
+    """Read Excel file and clean columns
 
-def load(datadir=DATADIR, 
-         filename="PP_Buitenhuisetal2013.xls"):
-    """Load excel file and convert to pandas dataframe"""
-    fn = os.path.join(datadir, filename)
-    if not os.path.isfile(fn):
-        download(datadir=datadir, filename=filename)
-    df = pd.read_excel(fn)
-    yearlist = [val if isinstance(val, int) else int(val[1:]) for val in list(df.Year)]
-    df.Year = yearlist
-    df = df[["Day", "Month", "Year", "LAT", "LONG", "Depth", "PP"]]
+    Only called on a cold load, the result is kept in the parquet cache.
+    """
+    with instrument.stage("read_excel", name=os.path.basename(filename),
+                          bytes=os.path.getsize(filename)) as rec:
+        df = pd.read_excel(filename, usecols=COLUMNS)
+        rec.rows = len(df)
+    return clean(df)
+
+def clean(df):
+    """Clean the columns of the raw Excel sheet
+
+    Some years carry a one character prefix, which is stripped before the
+    numeric conversion. PP entries that are not numbers are dropped
+    together with zero and negative values.
+    """
+    df = df[COLUMNS].copy()
+    year = pd.to_numeric(df["Year"], errors="coerce")
+    df["Year"] = year.fillna(pd.to_numeric(
+        df["Year"].astype(str).str[1:], errors="coerce"))
+    df["PP"] = pd.to_numeric(df["PP"], errors="coerce")
     df["date"] = pd.to_datetime(df[["Year", "Month", "Day"]])
     df.drop(columns=["Year","Month","Day"], inplace=True)
     df.rename(columns={"LAT":"lat", "LONG":"lon","Depth":"depth"}, inplace=True)
-    mask = df["PP"].apply(lambda x: isinstance(x, str))
-    df = df[~mask]
     df = df[df.PP>0]
     df.set_index("date", inplace=True)
     return df
 
-def download(datadir=DATADIR, 
+def download(datadir=None, 
              filename="PP_Buitenhuisetal2013.xls"):
     """Download Excel file from UEA server
     
     Refs
     ----
     """
+    datadir = DATADIR if datadir is None else datadir
     local_filename = os.path.join(datadir, filename)
-    try:
-        os.unlink(local_filename)
-    except FileNotFoundError:
-        pass
     url = f"{DATAURL}/{filename}"
-    try:
-        r = requests.get(url, stream=True, timeout=6)
-    except requests.ReadTimeout:
-        warnings.warn("Connection to server timed out.")
-        return False
-    if r.ok:
-        if local_filename is None:
-            return r.text
-        else:
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024): 
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-    else:
-        raise IOError(f"Could not download file from server, Error {r.status_code}")
+    return downloader.fetch(url, local_filename)
@@ -2,6 +2,7 @@
 import glob
 import os
 import io
+import json
 import pathlib
 import warnings
 import ftplib
@@ -10,25 +11,50 @@ from urllib.parse import urlsplit
 
 import numpy as np
 import pandas as pd
-import requests
 from datetime import datetime
-import click
-from bs4 import BeautifulSoup
 
-DATADIR = pathlib.PurePath(pathlib.Path.home(), ".oceandata/HOT/pp")
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+from .. import bundle, cache, downloader, filters, instrument, store
+
+DATADIR = pathlib.PurePath(store.path("HOT", "pp"))
 DATAURL = "https://hahana.soest.hawaii.edu/FTP/hot/primary_production/"
 DATAEXT = "pp"
+LON, LAT = -158.0, 22.75
+CACHE_VERSION = 1
+SKIPROWS = 7
+NAMES = ["cruise_ID", "inc",
+         "time", "date", "time_start", "time_end", "depth",
+         "Chl_Mean", "Chl_SD", "Pheo_Mean", "Pheo_SD",
+         "light1", "light2", "light3",
+         "dark1", "dark2", "dark3", "salt",
+         "Prochl",  "Hetero", "Synecho", "Euk", "flags"]
+INTEGERS = ["inc", "time", "time_start", "time_end", "flags"]
 
 def filelist():
     return list(pathlib.Path(DATADIR).glob("hot*.pp"))
 
-def listFD(url=None, ext=None):
+def list_remote(url=None, ext=None):
+    """Return name, url and listing stamp of all pp files on the server
+
+    The stamp is the modification time and size shown next to each link
+    in the directory listing, or None if the listing has none.
+    """
+    from bs4 import BeautifulSoup
     url = DATAURL if url is None else url
     ext = DATAEXT if ext is None else ext
-    page = requests.get(url).text
+    page = downloader.session().get(url, timeout=downloader.TIMEOUT).text
     soup = BeautifulSoup(page, 'html.parser')
-    return [url + '/' + node.get('href') for node in soup.find_all('a') if node.get('href').endswith(ext)]
+    remote = {}
+    for node in soup.find_all('a'):
+        href = node.get('href')
+        if href is None or not href.endswith(ext):
+            continue
+        stamp = node.next_sibling if isinstance(node.next_sibling, str) else ""
+        remote[href.split("/")[-1]] = {"url":url + '/' + href,
+                                       "stamp":" ".join(stamp.split()) or None}
+    return remote
+
+def listFD(url=None, ext=None):
+    return [info["url"] for info in list_remote(url=url, ext=ext).values()]
 
 def download(fileurl):
     """Download txt file from BATS server
@@ -37,61 +63,186 @@ def download(fileurl):
     ----
     """
     local_filename = DATADIR / fileurl.split("/")[-1]
+    return downloader.fetch(fileurl, local_filename)
 
-    try:
-        os.unlink(local_filename)
-    except FileNotFoundError:
-        pass
-    try:
-        r = requests.get(fileurl, stream=True, timeout=6)
-    except requests.ReadTimeout:
-        warnings.warn("Connection to server timed out.")
-        return False
-    if r.ok:
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024): 
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
-    else:
-        raise IOError(f"Could not download file from server, Error {r.status_code}")
 
+def download_all(workers=downloader.WORKERS):
+    """Download all pp files listed on the HOT server concurrently."""
+    import click
+    urls = listFD()
+    filenames = [DATADIR / url.split("/")[-1] for url in urls]
+    with click.progressbar(length=len(urls)) as bar:
+        downloader.fetch_many(urls, filenames, workers=workers,
+                              callback=lambda fn: bar.update(1))
 
-def generate_h5_file():
-    """Generate h5 file by downloading and concating pp files."""
-    with click.progressbar(listFD()) as urls:
-        for url in urls:
-            download(url)
-    dflist = [read_pp(p) for p in filelist()]
-    df = pd.concat(dflist)
-    df.to_hdf(DATADIR / "pp_hot.h5", "df")
+def read_pp_files(*filenames, source=False):
+    """Read several pp files in one pass
 
-def read_pp(filename):
-    names = ["cruise_ID", "inc",
-             "time", "date", "time_start", "time_end", "depth",
-             "Chl_Mean", "Chl_SD", "Pheo_Mean", "Pheo_SD",
-             "light1", "light2", "light3",
-             "dark1", "dark2", "dark3", "salt",
-             "Prochl",  "Hetero", "Synecho", "Euk", "flags"]
-    df = pd.read_csv(filename, skiprows=7, sep=" ", 
-                     skipinitialspace=True, names=names, na_values=-9, 
-                     index_col=False, converters={'date': str})
-    df["pp_light"] = np.nanmean(df[["light1", "light2", "light3"]], axis=1)
-    df["pp_dark"] = np.nanmean(df[["dark1", "dark2", "dark3"]], axis=1)
-    df["pp_obs"] = df["pp_light"] - df["pp_dark"]
-    df.loc[df.pp_obs<0, "pp_obs"] = 0
+    The data lines of all files are joined into one buffer that is parsed
+    by a single read_csv call. Replicate averaging, dark correction and
+    date conversion are then done once on the combined frame. With
+    source=True a categorical 'source' column holds the file name of
+    each row.
+    """
+    rows, counts = [], []
+    for fn in filenames:
+        with open(fn, "rb") as fH:
+            lines = fH.read().split(b"\n", SKIPROWS)
+        lines = [line for line in lines[-1].splitlines() if line.strip()
+                 ] if len(lines) > SKIPROWS else []
+        rows.extend(lines)
+        counts.append(len(lines))
+    data = b"\n".join(rows)
+    with instrument.stage("read_csv", name=f"{len(filenames)} pp files",
+                          bytes=len(data)) as rec:
+        df = pd.read_csv(io.BytesIO(data), sep=" ",
+                         skipinitialspace=True, names=NAMES, na_values=-9,
+                         index_col=False, dtype={'date': str})
+        rec.rows = len(df)
+    light = df[["light1", "light2", "light3"]].values
+    dark = df[["dark1", "dark2", "dark3"]].values
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        df["pp_light"] = np.nanmean(light, axis=1)
+        df["pp_dark"] = np.nanmean(dark, axis=1)
+    df["pp_obs"] = (df["pp_light"] - df["pp_dark"]).clip(lower=0)
     dtmvec = pd.to_datetime(df.date, format="%y%m%d")
     df.set_index(pd.DatetimeIndex(dtmvec), inplace=True)
-    df.drop(columns=["light1", "light2", "light3", 
+    df.drop(columns=["light1", "light2", "light3",
                      "dark1", "dark2", "dark3", "date"],
             inplace=True)
+    if source:
+        names = [os.path.basename(fn) for fn in filenames]
+        df["source"] = pd.Categorical.from_codes(
+            np.repeat(np.arange(len(names)), counts), categories=names)
     return df
 
+def read_pp(filename):
+    """Read one pp file"""
+    return read_pp_files(filename)
+
 
-def load(datadir=DATADIR, filename="pp_hot.h5"):
-    """Load tab file and fix some columns"""
-    if not os.path.isfile(DATADIR / filename):
-        generate_h5_file()
-    return pd.read_hdf(DATADIR / filename)
+def read_manifest(datadir=None):
+    """Return manifest of downloaded and parsed pp files"""
+    datadir = pathlib.PurePath(DATADIR if datadir is None else datadir)
+    try:
+        with open(datadir / "manifest.json") as fH:
+            return json.load(fH)
+    except (FileNotFoundError, ValueError):
+        return {"parser":None, "files":{}}
+
+def write_manifest(manifest, datadir=None):
+    datadir = pathlib.PurePath(DATADIR if datadir is None else datadir)
+    os.makedirs(datadir, exist_ok=True)
+    tmpfn = store.tmpname(datadir / "manifest.json")
+    with open(tmpfn, "w") as fH:
+        json.dump(manifest, fH, indent=1)
+    os.replace(tmpfn, datadir / "manifest.json")
+
+def part_filename(name, datadir=None):
+    """Return parquet file holding the parsed version of a pp file"""
+    datadir = pathlib.PurePath(DATADIR if datadir is None else datadir)
+    return datadir / "parts" / f"{os.path.splitext(name)[0]}.parquet"
+
+def update(workers=downloader.WORKERS, datadir=None):
+    """Download and parse only new or changed cruises
+
+    The remote listing is compared with the local manifest. Files with a
+    new listing stamp are fetched with conditional requests, and only the
+    ones whose sha256 differs from the manifest are parsed and written as
+    new parquet parts. All other parts are left untouched. Changing
+    read_pp_files triggers a reparse of every file. Files that could not
+    be fetched keep their old manifest entry, or get none, so the next
+    update retries them.
+
+    Returns the names of the files that were parsed.
+    """
+    datadir = pathlib.PurePath(DATADIR if datadir is None else datadir)
+    remote = list_remote()
+    with store.lock("hot"):
+        manifest = read_manifest(datadir)
+        parser = f"{CACHE_VERSION}:{cache.code_hash(read_pp_files)}"
+        if manifest["parser"] != parser:
+            manifest = {"parser":parser, "files":{}}
+        files = manifest["files"]
+        stale = [name for name, info in remote.items()
+                 if name not in files or info["stamp"] is None or
+                 files[name]["stamp"] != info["stamp"] or
+                 not os.path.isfile(part_filename(name, datadir))]
+        fetched = downloader.fetch_many(
+            [remote[name]["url"] for name in stale],
+            [datadir / name for name in stale], workers=workers)
+        pathlib.Path(datadir / "parts").mkdir(parents=True, exist_ok=True)
+        parsed = []
+        for name, result in zip(stale, fetched):
+            if not result:
+                continue
+            sha = downloader.read_meta(datadir / name).get("sha256")
+            entry = files.get(name, {})
+            if (sha is None or entry.get("sha256") != sha or
+                    not os.path.isfile(part_filename(name, datadir))):
+                parsed.append(name)
+            files[name] = {"stamp":remote[name]["stamp"], "sha256":sha}
+        if parsed:
+            df = read_pp_files(*[datadir / name for name in parsed],
+                               source=True)
+            for name, part in df.groupby("source", observed=False):
+                fn = part_filename(name, datadir)
+                part.drop(columns="source").to_parquet(store.tmpname(fn))
+                os.replace(store.tmpname(fn), fn)
+        write_manifest(manifest, datadir)
+        return parsed
+
+def generate_h5_file():
+    """Deprecated, the casts are kept as parquet parts by update()"""
+    warnings.warn("generate_h5_file is deprecated, use update() and load()",
+                  DeprecationWarning, stacklevel=2)
+    update()
+    load().to_hdf(DATADIR / "pp_hot.h5", key="df")
+
+@instrument.timed("load", name="hot")
+def load(datadir=None, filename=None, compact=False, bbox=None, start=None,
+         end=None, columns=None, depth=None):
+    """Load all parsed pp files as one dataframe
+
+    All casts are made at Station ALOHA (LON, LAT), so a bbox that does not
+    contain the station gives an empty dataframe. The times between start
+    and end, the depths in depth and the given columns are selected while
+    the parquet parts are read (see filters.build). With compact=True
+    floats are returned as float32, cruise_ID as a categorical and the
+    integer fields as nullable integers. The casts are read from the
+    active bundle when it holds them, unless datadir is given.
+
+    filename is deprecated. An existing h5 file written by
+    generate_h5_file() in datadir is still read when it is given.
+    """
+    bundled = datadir is None and filename is None and bundle.has("hot")
+    datadir = pathlib.PurePath(DATADIR if datadir is None else datadir)
+    dnf = filters.build(start=start, end=end, depth=depth)
+    if filename is not None:
+        warnings.warn("The filename argument is deprecated, the casts are "
+                      "kept as parquet parts in datadir",
+                      DeprecationWarning, stacklevel=3)
+    if filename is not None and os.path.isfile(datadir / filename):
+        df = filters.apply(pd.read_hdf(datadir / filename), dnf,
+                           columns=columns)
+    elif bundled:
+        df = bundle.read("hot", columns=columns, filters=dnf)
+    else:
+        manifest = read_manifest(datadir)
+        if len(manifest["files"]) == 0:
+            with store.lock("hot"):
+                if len(read_manifest(datadir)["files"]) == 0:
+                    update(datadir=datadir)
+            manifest = read_manifest(datadir)
+        parts = [part_filename(name, datadir)
+                 for name in sorted(manifest["files"])]
+        df = cache.read(parts, columns=columns, filters=dnf)
+    if bbox is not None and not filters.bbox_mask(LON, LAT, bbox):
+        df = df.iloc[:0]
+    if compact:
+        return cache.compact(df, categories=["cruise_ID"],
+                             integers=INTEGERS)
+    return df
 
 
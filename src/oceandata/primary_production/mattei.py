@@ -34,35 +34,91 @@ import warnings
 
 import numpy as np
 import pandas as pd
-import requests
 from datetime import datetime
 
-DATADIR = pathlib.PurePath(pathlib.Path.home(), ".oceandata")
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+from .. import bundle, cache, downloader, filters, instrument, store
+
+DATADIR = pathlib.PurePath(store.path())
 DATAURL = "https://download.pangaea.de/dataset/932417/files"
+FILENAME = "Global_marine_phytoplankton_production_dataset.txt"
+CACHE_VERSION = 1
+NCOLS = 43
+DATEFORMAT = "%d/%m/%Y"
+
+@instrument.timed("load", name="mattei")
+def load(datadir=None, filename=None, compact=False, bbox=None, start=None,
+         end=None, columns=None, depth=None):
+    """Load tab file and fix some columns
+
+    bbox = (lon1, lat1, lon2, lat2), start, end, depth and columns select
+    rows and columns while reading the cache, see filters.build. The
+    dataset is read from the active bundle when it holds one, unless
+    datadir or filename is given.
+    """
+    dnf = filters.build(bbox, start, end, depth)
+    if datadir is None and filename is None and bundle.has("mattei"):
+        df = bundle.read("mattei", columns=columns, filters=dnf)
+    else:
+        datadir = DATADIR if datadir is None else datadir
+        filename = FILENAME if filename is None else filename
+        fn = os.path.join(datadir, filename)
+        with store.lock("mattei"):
+            if not os.path.isfile(fn):
+                download(datadir=datadir, filename=filename)
+        df = cache.cached("mattei", fn, read_txt, version=CACHE_VERSION,
+                          columns=columns, filters=dnf)
+    return cache.compact(df) if compact else df
+
+class LineFilter:
+    """Read-only file object passing on the last ncols fields of data lines
 
-def load(datadir=DATADIR, 
-         filename="Global_marine_phytoplankton_production_dataset.txt"):
-    """Load tab file and fix some columns"""
-    fn = os.path.join(datadir, filename)
-    if not os.path.isfile(fn):
-        download(datadir=datadir, filename=filename)
-    with open(fn ,"r") as fH:
-        end = fH.seek(0, 2)
-        fH.seek(0)
-        string = "" #"\t".join(fH.readline().split("\t")[6:])
-        cnt = 0
-        while fH.tell() < end:
-            cnt += 1
-            part = fH.readline().split("\t")
-            if len(part) > 5: 
-                line = "\t".join(part[len(part)-43:])
-            else:
-                line = ""
-            string += line #"\t".join(line.split("\t")[6:])
-        fstr = io.StringIO(string)
-    df = pd.read_csv(fstr, sep="\t", parse_dates=True, index_col=0, 
-                     dayfirst=True) 
+    Lines with five or fewer fields (metadata) are dropped and prefix
+    columns are stripped on the fly, so the filtered text is fed straight
+    to the C parser without building a second copy of the file.
+    """
+    def __init__(self, fH, ncols=NCOLS):
+        self.lines = iter(fH)
+        self.ncols = ncols
+        self.buffer = ""
+
+    def __iter__(self):
+        for line in self.lines:
+            line = self.filter(line)
+            if line:
+                yield line
+
+    def filter(self, line):
+        parts = line.split("\t")
+        return "\t".join(parts[-self.ncols:]) if len(parts) > 5 else ""
+
+    def read(self, size=-1):
+        chunks, length = [self.buffer], len(self.buffer)
+        for line in self.lines:
+            line = self.filter(line)
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+def read_txt(filename):
+    """Read tab separated txt file and clean columns"""
+    with open(filename ,"r") as fH, instrument.stage(
+            "read_csv", name=os.path.basename(filename),
+            bytes=os.path.getsize(filename)) as rec:
+        df = pd.read_csv(LineFilter(fH), sep="\t", index_col=0)
+        rec.rows = len(df)
+    with instrument.stage("datetime", name=os.path.basename(filename),
+                          rows=len(df)):
+        try:
+            df.index = pd.to_datetime(df.index, format=DATEFORMAT)
+        except ValueError:
+            df.index = pd.to_datetime(df.index, dayfirst=True)
     #df2 = pd.read_csv(
     # "https://download.pangaea.de/dataset/932417/files/Global_marine_phytoplankton_production_dataset.txt", engine="python",
     #  on_bad_lines="skip", sep="\t", parse_dates=["Date"], index_col="Date", 
@@ -99,32 +155,14 @@ def load(datadir=DATADIR,
     return df
     #df.to_hdf("h5files/mattei_pp_global_data_clean.h5", "df")
 
-def download(datadir=DATADIR, 
+def download(datadir=None, 
              filename="Global_marine_phytoplankton_production_dataset.txt"):
     """Download txt file from BATS server
     
     Refs
     ----
     """
+    datadir = DATADIR if datadir is None else datadir
     local_filename = os.path.join(datadir, filename)
-    try:
-        os.unlink(local_filename)
-    except FileNotFoundError:
-        pass
     url = f"{DATAURL}/{filename}"
-    try:
-        r = requests.get(url, stream=True, timeout=6)
-    except requests.ReadTimeout:
-        warnings.warn("Connection to server timed out.")
-        return False
-    if r.ok:
-        if local_filename is None:
-            return r.text
-        else:
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024): 
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-    else:
-        raise IOError(f"Could not download file from server, Error {r.status_code}")
+    return downloader.fetch(url, local_filename)
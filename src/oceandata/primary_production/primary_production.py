@@ -1,28 +1,27 @@
 import numpy as np
 import pandas as pd
 
-def read_buitenhuis():
-    df = pd.read_hdf("buiten_pp_longhurst.h5")
-    df.set_index(pd.DatetimeIndex(df.date), inplace=True)
-    df["sst"] = ostia.match(df.lon,df.lat,df.index)
+from .. import matchup
+from . import buitenhuis
 
-    cc = cci.LocalPML(ver="5.0")
-    jdvec = date2num(df.date)
-    mask = df.index>="1998-01-01"
-    df["chl"] = np.nan
-    df.loc[mask, "chl"] = cc.match(
-        "chl", df.lon[mask], df.lat[mask], jdvec[mask], nei=9)
-    df["kd_490"] = np.nan
-    df.loc[mask, "kd_490"] = cc.match(
-        "kd490", df.lon[mask], df.lat[mask], jdvec[mask], nei=9)
-    df["Zeu"] = 4.6 / df["kd_490"]
+def read_buitenhuis(products=None, nei=3):
+    """Match the Buitenhuis PP database with local gridded products
 
-    ns = nasa.MODIS(res="4km")
-    mask = df.index>="2003-01-01"
-    df["par"] = np.nan
-    df.loc[mask, "par"] = ns.match("par", df.lon[mask], df.lat[mask], jdvec[mask])
+    products maps a new column name to (filenames, var), where filenames
+    is called with a date and returns the local product file for that day
+    or None (see matchup.match_files). Example:
+
+        products = {"sst":(ostia_file, "analysed_sst"),
+                    "chl":(cci_file, "chlor_a"),
+                    "kd_490":(cci_kd_file, "kd_490"),
+                    "par":(modis_file, "par")}
+    """
+    products = {} if products is None else products
+    df = buitenhuis.load()
+    for key, (filenames, var) in products.items():
+        df[key] = matchup.match_files(filenames, var, df.lon, df.lat,
+                                      df.index, nei=nei)
+    if "kd_490" in df:
+        df["Zeu"] = 4.6 / df["kd_490"]
     df["month"] = df.index.month
-    df.to_hdf("h5files/buiten_pp_longhurst_sat.h5", "df")
     return df
-
-
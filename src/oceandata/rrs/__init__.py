@@ -0,0 +1,11 @@
+import importlib
+
+SUBMODULES = ["valente"]
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
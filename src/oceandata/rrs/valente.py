@@ -36,21 +36,30 @@ import pathlib
 import numpy as np
 import pandas as pd
 
-from ..chl.valente import DATADIR, download
+from .. import bundle, cache, filters, instrument, pangaea
+from ..chl.valente import DATADIR, CACHE_VERSION, download, source
 
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+FILENAME = "insitudb_rrs_satbands6_V3.tab"
 
-def load(datadir=DATADIR, filename="insitudb_rrs_satbands6_V3.tab"):
-    """Load tab file and fix some columns"""
-    fn = os.path.join(datadir, "datasets", filename)
-    if not os.path.isfile(fn):
-        download(datadir=datadir)
-    with open(fn ,"r") as fH: 
-        while 1: 
-            line = fH.readline() 
-            if "*/" in line: 
-                break
-        df = pd.read_csv(fH, sep="\t", parse_dates=[1,])
+@instrument.timed("load", name="valente_rrs")
+def load(datadir=None, filename=None, compact=False, bbox=None, start=None,
+         end=None, columns=None, depth=None):
+    """Load tab file and fix some columns, arguments as in chl.valente"""
+    dnf = filters.build(bbox, start, end, depth)
+    if datadir is None and filename is None and bundle.has("valente_rrs"):
+        df = bundle.read("valente_rrs", columns=columns, filters=dnf)
+    else:
+        datadir = DATADIR if datadir is None else datadir
+        filename = FILENAME if filename is None else filename
+        fn, member = source(filename, datadir=datadir)
+        df = cache.cached("valente_rrs", fn, read_tab, version=CACHE_VERSION,
+                          kwargs={"member":member}, columns=columns,
+                          filters=dnf)
+    return cache.compact(df) if compact else df
+
+def read_tab(filename, member=None):
+    """Read Pangaea tab file and rename columns"""
+    df = pangaea.read_tab(filename, member=member)
     df = df.rename(columns={"Latitude":"lat", "Longitude":"lon"})
     #df["lat"] = df["Latitude"]
     #df["lon"] = df["Longitude"]
@@ -33,26 +33,20 @@ DOI:10.5194/essd-8-235-2016
 import glob
 import os
 import pathlib
-import zipfile
 import warnings
 
 import numpy as np
 import pandas as pd
-import requests
 
-DATADIR = os.path.expanduser("~/.oceandata/valente_iop")
-pathlib.Path(DATADIR).mkdir(parents=True, exist_ok=True)
+from . import downloader, pangaea, store
+
+DATADIR = store.path("valente_iop")
 FILENAME = "valente_2019.zip"
 
 def load_chl(filename="insitudb_chla.tab"):
     """Load tab file and fix some columns"""
     fn = os.path.join(DATADIR, "datasets", filename)
-    with open(fn ,"r") as fH: 
-        while 1: 
-            line = fH.readline() 
-            if "*/" in line: 
-                break
-        df = pd.read_csv(fH, sep="\t", parse_dates=[1,])
+    df = pangaea.read_tab(fn)
     df["lat"] = df["Latitude"]
     df["lon"] = df["Longitude"]
     df["chl_hpcl"] = df["Chl a [mg/m**3] (High Performance Liquid Chrom...)"]
@@ -75,30 +69,10 @@ def download(url="https://doi.pangaea.de/10.1594/PANGAEA.898188",
     """
     filename = FILENAME if filename is None else filename
     local_filename = os.path.join(DATADIR, filename)
-    try:
-        os.unlink(local_filename)
-    except FileNotFoundError:
-        pass
-
-    try:
-        r = requests.get(url, params=params, stream=True, timeout=6)
-    except requests.ReadTimeout:
-        warnings.warn("Connection to server timed out.")
-        return False
-    if r.ok:
-        if local_filename is None:
-            return r.text
-        else:
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024): 
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-    else:
-        raise IOError("Could not download file from server")
-
-    with zipfile.ZipFile(local_filename,"r") as zip_ref:
-        zip_ref.extractall(DATADIR)
+    with store.lock("valente_iop"):
+        if not downloader.fetch(url, local_filename, params=params):
+            return False
+        store.extract(local_filename, DATADIR)
 
 
 def download_pml(url="https://github.com/brorfred/oceandata/raw/master/data/",
@@ -0,0 +1,145 @@
+"""Shared on-disk data store
+
+All raw files, caches and lock files live below one root directory,
+~/.oceandata by default. The root can be moved with the OCEANDATA_DIR
+environment variable or with set_root(). set_root() also moves the
+DATADIR, CACHEDIR and TRAJDIR paths of modules that are already
+imported, as long as they are below the old root.
+
+A pre-parsed dataset bundle (see bundle.py) is served before anything in
+the store. It is found in ROOT/bundle after `oceandata bundle import`, or
+at the directory or archive given by OCEANDATA_BUNDLE or set_bundle(),
+which may be read-only.
+
+Processes sharing the store serialize downloads and parsing of a dataset
+with per-dataset lock files, so when many workers start on a cold node
+exactly one of them fetches and parses while the others wait and then
+read the finished files. Files are always written to a temporary name
+and renamed into place.
+
+Example:
+    with store.lock("valente"):
+        if not os.path.isfile(fn):
+            download()
+
+"""
+import os
+import re
+import sys
+import zipfile
+import threading
+import contextlib
+
+ROOT = os.environ.get("OCEANDATA_DIR", os.path.expanduser("~/.oceandata"))
+PATHS = ["DATADIR", "CACHEDIR", "TRAJDIR"]
+BUNDLE = os.environ.get("OCEANDATA_BUNDLE")
+
+_guard = threading.Lock()
+_locks = {}
+
+
+def set_root(root):
+    """Move the store and the paths below it of imported modules"""
+    global ROOT
+    old, ROOT = ROOT, os.path.abspath(os.path.expanduser(root))
+    for name, module in list(sys.modules.items()):
+        if not name.startswith(f"{__package__}."):
+            continue
+        for attr in PATHS:
+            value = getattr(module, attr, None)
+            if value is not None and _below(value, old):
+                rel = os.path.relpath(os.path.abspath(value), old)
+                setattr(module, attr,
+                        type(value)(os.path.normpath(os.path.join(ROOT, rel))))
+
+
+def set_bundle(bundle):
+    """Serve datasets from a bundle directory or archive, None to stop"""
+    global BUNDLE
+    BUNDLE = None if bundle is None else os.path.abspath(
+        os.path.expanduser(bundle))
+
+
+def path(*parts):
+    """Return path below the store root"""
+    return os.path.join(ROOT, *parts)
+
+
+@contextlib.contextmanager
+def lock(name):
+    """Hold an exclusive inter-process lock for a dataset
+
+    The lock is reentrant within a process, so nested calls with the same
+    name from one thread do not deadlock.
+    """
+    with _guard:
+        entry = _locks.setdefault(name, [threading.RLock(), 0, None])
+    with entry[0]:
+        if entry[1] == 0:
+            fn = path("locks", re.sub(r"[^\w.-]", "_", name) + ".lock")
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            entry[2] = open(fn, "a+")
+            _lock_file(entry[2])
+        entry[1] += 1
+        try:
+            yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                _unlock_file(entry[2])
+                entry[2].close()
+                entry[2] = None
+
+
+def _below(path, root):
+    try:
+        path, root = os.path.abspath(path), os.path.abspath(root)
+        return os.path.commonpath([path, root]) == root
+    except (TypeError, ValueError):
+        return False
+
+
+def tmpname(filename):
+    """Return a temporary name next to filename, unique to this process"""
+    return f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def extract(zipfilename, datadir, members=None):
+    """Extract members of a zip file, each one atomically"""
+    with zipfile.ZipFile(zipfilename, "r") as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir() or (members is not None and
+                                 info.filename not in members):
+                continue
+            fn = os.path.join(datadir, info.filename)
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with zip_ref.open(info) as src, open(tmpname(fn), "wb") as dst:
+                while block := src.read(1 << 20):
+                    dst.write(block)
+            os.replace(tmpname(fn), fn)
+
+
+try:
+    import fcntl
+
+    def _lock_file(fH):
+        fcntl.flock(fH.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(fH):
+        fcntl.flock(fH.fileno(), fcntl.LOCK_UN)
+
+except ImportError:
+    import msvcrt
+
+    def _lock_file(fH):
+        fH.seek(0)
+        while True:
+            try:
+                msvcrt.locking(fH.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def _unlock_file(fH):
+        fH.seek(0)
+        msvcrt.locking(fH.fileno(), msvcrt.LK_UNLCK, 1)
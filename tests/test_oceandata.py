@@ -1,10 +1,24 @@
 from oceandata import __version__
 
+import os
 import tempfile
 
 import pandas as pd
+import pytest
 import oceandata
 
+SAMPLEDIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+@pytest.fixture(autouse=True)
+def store_root(tmp_path, monkeypatch):
+    """Keep the data, caches and locks of every test below tmp_path"""
+    from oceandata import store
+    monkeypatch.setenv("OCEANDATA_DIR", str(tmp_path))
+    old = store.ROOT
+    store.set_root(tmp_path)
+    yield store.ROOT
+    store.set_root(old)
+
 def test_version():
     assert __version__ == '0.3.1'
 
@@ -50,9 +64,953 @@ def test_buitenhuis():
         df = buitenhuis.load(datadir=tmpdirname)
     assert_dataframe(df)
 
+def test_buitenhuis_clean(monkeypatch):
+    import numpy as np
+    from oceandata import cache
+    from oceandata.primary_production import buitenhuis
+    raw = pd.DataFrame({"Day":[1, 2, 3, 4, 5], "Month":[1, 2, 3, 4, 5],
+                        "Year":[1998, "~1999", 2000, "'2001", 2002],
+                        "LAT":np.arange(5.0), "LONG":-np.arange(5.0),
+                        "Depth":[0, 5, 10, 20, 50],
+                        "PP":[10.5, "n.d.", 0, 3.2, 7],
+                        "Reference":list("abcde")})
+    df = buitenhuis.clean(raw)
+    assert list(df.columns) == ["lat", "lon", "depth", "PP"]
+    assert list(df.index) == [pd.Timestamp("1998-01-01"),
+                              pd.Timestamp("2001-04-04"),
+                              pd.Timestamp("2002-05-05")]
+    assert df["PP"].dtype == np.float64 and list(df["PP"]) == [10.5, 3.2, 7]
+    calls = []
+    def read_excel(filename, usecols=None):
+        calls.append(filename)
+        return raw.copy()
+    monkeypatch.setattr(pd, "read_excel", read_excel)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fn = os.path.join(tmpdirname, "pp.xls")
+        with open(fn, "w") as fH:
+            fH.write("xls")
+        for _ in range(2):
+            cache.cached("buitenhuis", fn, buitenhuis.read_xls,
+                         cachedir=tmpdirname)
+        assert len(calls) == 1
+        clean = buitenhuis.clean
+        monkeypatch.setattr(buitenhuis, "clean",
+                            lambda df: clean(df).assign(PP=lambda d: -d.PP))
+        df = cache.cached("buitenhuis", fn, buitenhuis.read_xls,
+                          cachedir=tmpdirname)
+        assert len(calls) == 2 and list(df["PP"]) == [-10.5, -3.2, -7]
+
 def test_mouw():
     from oceandata.export_production import mouw
     df = mouw.load()
     with tempfile.TemporaryDirectory() as tmpdirname:
         df = mouw.load(datadir=tmpdirname)
-    assert_dataframe(df)
\ No newline at end of file
+    assert_dataframe(df)
+
+def test_cache():
+    from oceandata import cache
+    calls = []
+    def reader(filename):
+        calls.append(filename)
+        df = pd.read_csv(filename)
+        return df.set_index(pd.DatetimeIndex(df["date"]))
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fn = os.path.join(tmpdirname, "raw.csv")
+        with open(fn, "w") as fH:
+            fH.write("date,lat,lon\n2000-01-01,1,2\n2000-01-02,3,4\n")
+        df1 = cache.cached("test", fn, reader, cachedir=tmpdirname)
+        df2 = cache.cached("test", fn, reader, cachedir=tmpdirname)
+        assert len(calls) == 1
+        pd.testing.assert_frame_equal(df1, df2, check_freq=False)
+        with open(fn, "a") as fH:
+            fH.write("2000-01-03,5,6\n")
+        df3 = cache.cached("test", fn, reader, cachedir=tmpdirname)
+        assert len(calls) == 2
+        assert len(df3) == 3
+        df4 = cache.cached("test", fn, reader, version=2, cachedir=tmpdirname)
+        assert len(calls) == 3
+        assert len(os.listdir(os.path.join(tmpdirname))) == 3
+        assert_dataframe(df4)
+
+def test_cache_kwargs():
+    from oceandata import cache
+    calls = []
+    def reader(filename, scale=1):
+        calls.append(scale)
+        return pd.DataFrame({"a":[1.0, 2.0]}) * scale
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fn = os.path.join(tmpdirname, "raw.csv")
+        with open(fn, "w") as fH:
+            fH.write("a\n1\n2\n")
+        for _ in range(3):
+            for scale in [1, 2]:
+                df = cache.cached("test", fn, reader, kwargs={"scale":scale},
+                                  cachedir=tmpdirname)
+                assert df["a"].iloc[1] == 2 * scale
+        assert calls == [1, 2]
+        with open(fn, "a") as fH:
+            fH.write("3\n")
+        cache.cached("test", fn, reader, kwargs={"scale":2},
+                     cachedir=tmpdirname)
+        assert calls == [1, 2, 2]
+        assert len([fn for fn in os.listdir(tmpdirname)
+                    if fn.endswith(".parquet")]) == 2
+
+def test_cache_prefix():
+    from oceandata import cache
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fn = os.path.join(tmpdirname, "raw.csv")
+        with open(fn, "w") as fH:
+            fH.write("a\n1\n2\n")
+        reader = lambda filename: pd.read_csv(filename)
+        pml = cache.cached("test_pml", fn, reader, cachedir=tmpdirname)
+        cache.cached("test", fn, reader, cachedir=tmpdirname)
+        cache.cached("test", fn, reader, version=2, cachedir=tmpdirname)
+        assert len(cache.entries("test", cachedir=tmpdirname)) == 1
+        assert len(cache.entries("test_pml", cachedir=tmpdirname)) == 1
+        cache.clear("test", cachedir=tmpdirname)
+        assert cache.entries("test", cachedir=tmpdirname) == []
+        pd.testing.assert_frame_equal(
+            cache.read(cache.entries("test_pml", cachedir=tmpdirname)), pml)
+        cache.clear(cachedir=tmpdirname)
+        assert cache.entries(cachedir=tmpdirname) == []
+
+def test_code_hash(monkeypatch):
+    from oceandata import cache, gdp, mapps, pangaea
+    from oceandata.chl import valente
+    from oceandata.export_production import mouw
+    readers = [gdp.read_dat, valente.read_tab, mapps.read_tab, mouw.read_tab]
+    hashes = [cache.code_hash(reader) for reader in readers]
+    assert hashes == [cache.code_hash(reader) for reader in readers]
+    monkeypatch.setattr(gdp, "_clean", lambda df: df)
+    assert cache.code_hash(gdp.read_dat) != hashes[0]
+    monkeypatch.setattr(pangaea, "read_tab", lambda filename: None)
+    assert all(cache.code_hash(reader) != old
+               for reader, old in zip(readers[1:], hashes[1:]))
+
+def test_gdp_iter_chunks():
+    from oceandata import gdp
+    fn = os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz")
+    full = gdp.read_dat(fn, sst=True)
+    chunks = list(gdp.iter_chunks(filename=fn, chunksize=100,
+                                  bbox=(130, 35, 135, 38),
+                                  start="2010-10-15", end="2010-12-01",
+                                  columns=["id", "lat", "lon", "sst"]))
+    assert len(chunks) > 1
+    df = pd.concat(chunks)
+    mask = ((full.lon >= 130) & (full.lon <= 135) &
+            (full.lat >= 35) & (full.lat <= 38) &
+            (full.index >= "2010-10-15") & (full.index <= "2010-12-01"))
+    pd.testing.assert_frame_equal(df, full[mask])
+    df = pd.concat(gdp.iter_chunks(filename=fn, ids=[72619], columns=["id"]))
+    assert (df.id == 72619).all()
+    assert len(df) == (full.id == 72619).sum()
+
+def test_gdp_load_workers():
+    import shutil
+    from oceandata import gdp
+    for v1 in gdp.SEGMENTS:
+        shutil.copy(os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz"),
+                    gdp.segment_filename(v1))
+    df1 = gdp.load(sst=True, workers=4)
+    df2 = gdp.load(sst=True)
+    assert len(df1) == 4 * len(gdp.read_dat(
+        os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz")))
+    pd.testing.assert_frame_equal(df1, df2)
+
+def test_gdp_load_spawn(monkeypatch, tmp_path):
+    import shutil
+    import functools
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from oceandata import gdp, store
+    monkeypatch.delenv("OCEANDATA_DIR")
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.setattr(gdp, "ProcessPoolExecutor", functools.partial(
+        ProcessPoolExecutor, mp_context=multiprocessing.get_context("spawn")))
+    monkeypatch.setattr(gdp, "SEGMENTS", {1:5000, 5001:10000})
+    for v1 in gdp.SEGMENTS:
+        shutil.copy(os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz"),
+                    gdp.segment_filename(v1))
+    df = gdp.load(sst=True, workers=2)
+    assert len(df) == 2 * len(gdp.read_dat(
+        os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz")))
+    assert not os.path.exists(tmp_path / "home")
+    assert {f"cache_buoydata_{v1}.lock" for v1 in gdp.SEGMENTS} <= set(
+        os.listdir(store.path("locks")))
+
+def test_gdp_load_columns(monkeypatch):
+    import shutil
+    from oceandata import gdp
+    shutil.copy(os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz"),
+                gdp.segment_filename(1))
+    df = gdp.load(1)
+    assert list(df.columns) == ["id", "lat", "lon"]
+    monkeypatch.setattr(pd, "read_csv", None)
+    df = gdp.load(1, vel=True)
+    assert list(df.columns) == ["id", "lat", "lon",
+                                "vel_east", "vel_north", "speed"]
+    assert_dataframe(df)
+
+def test_compact(monkeypatch):
+    import shutil
+    import numpy as np
+    from oceandata import gdp, cache, mapps
+    df = pd.DataFrame({"a":[1.5, 2.5, np.nan, 4.0], "n":[1, 2, 3, 4],
+                       "flags":[1.0, np.nan, 3.0, 0.0],
+                       "region":["NADR", "NADR", "GFST", "NADR"],
+                       "ref":["a", "b", "c", "d"]})
+    dfc = cache.compact(df, integers=["flags"])
+    assert dfc.dtypes.astype(str).to_dict() == {
+        "a":"float32", "n":"int32", "flags":"Int32", "region":"category",
+        "ref":"object"}
+    assert dfc["flags"].isna().sum() == 1
+    for v1 in gdp.SEGMENTS:
+        shutil.copy(os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz"),
+                    gdp.segment_filename(v1))
+    df = gdp.load(sst=True)
+    dfc = gdp.load(sst=True, compact=True)
+    pd.testing.assert_frame_equal(gdp.load(sst=True, compact=True,
+                                           workers=2), dfc)
+    monkeypatch.setattr(mapps, "DATADIR", SAMPLEDIR)
+    pml = mapps.load_pml(compact=True)
+    assert dfc["id"].dtype == "category" and dfc["sst"].dtype == np.float32
+    assert (dfc.memory_usage(index=False).sum() <
+            df.memory_usage(index=False).sum() / 2)
+    assert np.allclose(dfc["lat"], df["lat"], atol=1e-4)
+    assert (dfc["id"].astype(np.int64).values == df["id"].values).all()
+    assert pml["region"].dtype == "category" and pml["chl"].dtype == np.float32
+
+def test_load_filters(monkeypatch):
+    import shutil
+    import numpy as np
+    from oceandata import gdp, mapps
+    monkeypatch.setattr(mapps, "DATADIR", SAMPLEDIR)
+    full = mapps.load_pml()
+    for bbox in [(-80, 0, 20, 60), (100, -60, -100, 60)]:
+        df = mapps.load_pml(bbox=bbox, start="1990-01-01",
+                            end="2000-12-31", depth=(5, 50),
+                            columns=["lat", "lon", "chl"])
+        mask = (gdp.filters.bbox_mask(full.lon, full.lat, bbox) &
+                (full.index >= "1990-01-01") &
+                (full.index <= "2000-12-31") &
+                (full.depth >= 5) & (full.depth <= 50))
+        assert 0 < len(df) < len(full)
+        pd.testing.assert_frame_equal(
+            df, full.loc[mask, ["lat", "lon", "chl"]])
+    shutil.copy(os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz"),
+                gdp.segment_filename(1))
+    bbox = (130, 36, 135, 40)
+    df = gdp.load(1, bbox=bbox, end="2010-12-01",
+                  columns=["id", "lat", "sst"])
+    expected = pd.concat(gdp.iter_chunks(1, bbox=bbox, end="2010-12-01",
+                                         columns=["id", "lat", "sst"]))
+    assert 0 < len(df) < 500
+    pd.testing.assert_frame_equal(df, expected, check_freq=False)
+    try:
+        gdp.load(1, depth=15)
+        assert False
+    except KeyError:
+        pass
+
+def test_gdp_trajectories():
+    from oceandata import gdp
+    fn = os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz")
+    full = gdp.read_dat(fn, **gdp.ALLCOLUMNS)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        trajdir = gdp.build_trajectories([fn], os.path.join(tmpdirname, "tr"))
+        store = gdp.TrajectoryStore(trajdir)
+        assert len(store) == full.id.nunique()
+        df = store.trajectory(72619)
+        pd.testing.assert_frame_equal(df, full[full.id == 72619],
+                                      check_index_type=False, check_freq=False)
+        assert len(store.trajectories([72615, 72619])) == full.id.isin(
+            [72615, 72619]).sum()
+        assert sum(len(df) for id, df in store) == len(full)
+        assert gdp.open_trajectories(trajdir) is gdp.open_trajectories(trajdir)
+        gdp.build_trajectories([fn], trajdir)
+        assert trajdir not in gdp._stores
+        pd.testing.assert_frame_equal(gdp.trajectory(72619, trajdir=trajdir),
+                                      df)
+
+def test_gdp_kinematics():
+    import numpy as np
+    from oceandata import gdp
+    dtm = pd.date_range("2010-01-01", periods=4, freq="h")
+    df = pd.DataFrame({"id":[2, 2, 2, 2, 1, 1, 1, 1],
+                       "lat":[0, 0, 0, 0, 10, 10.01, 10.02, 10.02],
+                       "lon":[0, 0.01, 0.02, 0.04, 50, 50, 50, 50.01]},
+                      index=dtm.append(dtm))
+    kin = gdp.kinematics(df)
+    assert (kin["id"].values == [1, 1, 1, 1, 2, 2, 2, 2]).all()
+    step = 6371e3 * np.radians(0.01)
+    east = kin[kin["id"] == 2]
+    assert np.allclose(east["displacement"].iloc[1:], [step, step, 2 * step])
+    assert np.allclose(east["heading"].iloc[1:], 90)
+    assert np.allclose(east["ground_speed"].iloc[1:],
+                       [step / 3600, step / 3600, 2 * step / 3600])
+    assert np.allclose(east["acceleration"].iloc[2:], [0, step / 3600**2])
+    assert np.allclose(east["curvature"].iloc[2:], 0, atol=1e-12)
+    assert np.allclose(east["age"], [0, 1 / 24, 2 / 24, 3 / 24])
+    assert kin.iloc[[0, 4]][gdp.KINEMATICS[:-1]].isna().all().all()
+    assert kin.iloc[[1, 5]][["acceleration", "curvature"]].isna().all().all()
+    assert 0 < kin["curvature"].iloc[3] < 2 / step
+    filename = os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz")
+    full = gdp.kinematics(gdp.read_dat(filename))
+    dt = full.index.to_series().groupby(full["id"].values).diff()
+    assert np.allclose(full["displacement"] / dt.dt.total_seconds().values,
+                       full["ground_speed"], equal_nan=True)
+    chunks = gdp.iter_kinematics(gdp.iter_chunks(
+        filename=filename, columns=["id", "lat", "lon"], chunksize=37))
+    pd.testing.assert_frame_equal(pd.concat(chunks), full, check_freq=False)
+
+def test_gdp_query():
+    from oceandata import gdp
+    fn = os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz")
+    full = gdp.read_dat(fn, **gdp.ALLCOLUMNS)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        trajdir = gdp.build_trajectories([fn], os.path.join(tmpdirname, "tr"))
+        df = gdp.query(bbox=(130, 35, 135, 38), start="2010-10-15",
+                       end="2010-12-01", trajdir=trajdir)
+    mask = ((full.lon >= 130) & (full.lon <= 135) &
+            (full.lat >= 35) & (full.lat <= 38) &
+            (full.index >= "2010-10-15") & (full.index <= "2010-12-01"))
+    assert len(df) == mask.sum() > 0
+    expected = full[mask].reset_index().sort_values(["id", "index"])
+    assert (df.lat.values == expected.lat.values).all()
+
+def write_mattei(filename, nrows=50):
+    names = (["Date", "Latitude", "Longitude", "Year", "Month",
+              "Day of the year", "Bottom depth (m)", "Bottom depth sd (m)",
+              "Northern hemisphere season", "PAR_flag", "SST_flag",
+              "hemisphere", "SST (°C)", "SST magnitude",
+              "Depth-integrated primary production (mg C m^-2 day^-1)"] +
+             [f"var{i}" for i in range(28)])
+    with open(filename, "w") as fH:
+        fH.write("Global marine phytoplankton production dataset\n\n")
+        fH.write("\t".join(["ID", "Source", "Cruise"] + names) + "\n")
+        for row in range(nrows):
+            date = pd.Timestamp("1990-01-01") + pd.Timedelta(days=37 * (row % 300))
+            values = [date.strftime("%d/%m/%Y"), 10 + row % 7, -190 + row,
+                      date.year, date.month, date.dayofyear] + [row] * 37
+            fH.write("\t".join(str(v) for v in [row, "src", "cr"] + values))
+            fH.write("\n")
+    return filename
+
+def test_mattei_read_txt():
+    from oceandata.primary_production import mattei
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fn = write_mattei(os.path.join(tmpdirname, "mattei.txt"))
+        df = mattei.read_txt(fn)
+    assert len(df) == 50
+    assert df.index[1] == pd.Timestamp("1990-02-07")
+    assert "sst" in df and "PP" in df and "Year" not in df
+    assert df.lon.min() >= -180
+
+def write_pangaea(filename, nrows=50):
+    columns = ["Event", "Date/Time", "Latitude", "Longitude",
+               "Chl a [mg/m**3] (High Performance Liquid Chrom...)",
+               "Chl a [mg/m**3] (Chlorophyll a, fluorometric o...)"]
+    with open(filename, "w") as fH:
+        fH.write("/* DATA DESCRIPTION:\n")
+        fH.write("Citation:\tValente, A et al. (2022): In situ chlorophyll. "
+                 "PANGAEA, https://doi.org/10.1594/PANGAEA.941318\n")
+        fH.write("Parameter(s):\tDate/Time (Date/Time) * GEOCODE\n")
+        fH.write("\tLatitude (Latitude) * GEOCODE\n")
+        fH.write("License:\tCreative Commons Attribution 4.0 International\n")
+        fH.write("*/\n")
+        fH.write("\t".join(columns) + "\n")
+        for row in range(nrows):
+            date = pd.Timestamp("1998-01-01") + pd.Timedelta(hours=7 * row)
+            fH.write(f"ev{row % 3}\t{date:%Y-%m-%dT%H:%M}\t{row % 90}\t"
+                     f"{row % 180 - 90}\t{row / 10}\t\n")
+    return filename
+
+def test_pangaea():
+    from oceandata import pangaea
+    from oceandata.chl import valente
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fn = write_pangaea(os.path.join(tmpdirname, "chl.tab"))
+        meta = pangaea.describe(fn)
+        assert meta["doi"] == "10.1594/PANGAEA.941318"
+        assert meta["columns"][1] == "Date/Time"
+        assert len(meta["parameter(s)"]) == 2
+        assert pangaea.schema(fn)["Chl a [mg/m**3] (Chlorophyll a, "
+                                  "fluorometric o...)"] == "float64"
+        df = valente.read_tab(fn)
+    assert len(df) == 50
+    assert df["chl_fluo"].dtype == "float64"
+    assert_dataframe(df)
+
+def test_pangaea_coerce():
+    from oceandata import pangaea
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fn = write_pangaea(os.path.join(tmpdirname, "chl.tab"))
+        with open(fn) as fH:
+            text = fH.read().replace("\t2.5\t", "\tn.d.\t")
+        with open(fn, "w") as fH:
+            fH.write(text)
+        with pytest.warns(UserWarning, match="High Performance.*'n.d.'"):
+            df = pangaea.read_tab(fn)
+    col = "Chl a [mg/m**3] (High Performance Liquid Chrom...)"
+    assert df[col].dtype == "float64"
+    assert df[col].isna().sum() == 1 and df[col].iloc[24] == 2.4
+    assert df["Latitude"].dtype == "float64"
+
+def test_valente_zip():
+    import zipfile
+    from oceandata.chl import valente
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fn = write_pangaea(os.path.join(tmpdirname, "chl.tab"), nrows=200)
+        zipfilename = os.path.join(tmpdirname, "valente_2022.zip")
+        with zipfile.ZipFile(zipfilename, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.write(fn, "datasets/insitudb_chla_V3.tab")
+            zf.writestr("datasets/insitudb_rrs_V3.tab", "unused")
+        df = valente.load(datadir=tmpdirname)
+        assert not os.path.exists(os.path.join(tmpdirname, "datasets"))
+        pd.testing.assert_frame_equal(df, valente.read_tab(fn))
+        df = valente.load(datadir=tmpdirname, start="1998-01-10",
+                          columns=["chl_fluo"])
+        assert len(df) == 200 - 31 and list(df.columns) == ["chl_fluo"]
+
+class HTTPServer:
+    """Local stand-in server serving files from a directory
+
+    Supports ETag/If-None-Match and single byte Range requests, and logs
+    the request headers of every GET.
+    """
+    def __init__(self, directory):
+        import functools
+        import threading
+        import hashlib
+        from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+        requests = self.requests = []
+        class Handler(SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                requests.append(dict(self.headers))
+                fn = self.translate_path(self.path)
+                if os.path.isdir(fn):
+                    fn = os.path.join(fn, "index.html")
+                if not os.path.isfile(fn):
+                    return self.send_error(404)
+                data = open(fn, "rb").read()
+                etag = '"%s"' % hashlib.md5(data).hexdigest()
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                start = 0
+                if ("Range" in self.headers and
+                        self.headers.get("If-Range") in (None, etag)):
+                    start = int(self.headers["Range"][6:].split("-")[0])
+                    self.send_response(206)
+                    self.send_header("Content-Range",
+                                     f"bytes {start}-{len(data)-1}/{len(data)}")
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(data) - start))
+                self.end_headers()
+                self.wfile.write(data[start:])
+        handler = functools.partial(Handler, directory=directory)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+def test_downloader():
+    from oceandata import downloader
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        srvdir = os.path.join(tmpdirname, "srv")
+        os.mkdir(srvdir)
+        for i in range(5):
+            with open(os.path.join(srvdir, f"hot{i}.pp"), "wb") as fH:
+                fH.write(os.urandom(3 * downloader.CHUNKSIZE // 2 + i))
+        with HTTPServer(srvdir) as srv:
+            fn = downloader.fetch(f"{srv.url}/hot0.pp",
+                                  os.path.join(tmpdirname, "hot0.pp"))
+            assert open(fn, "rb").read() == open(
+                os.path.join(srvdir, "hot0.pp"), "rb").read()
+            done = []
+            urls = [f"{srv.url}/hot{i}.pp" for i in range(5)]
+            fns = [os.path.join(tmpdirname, f"hot{i}.pp") for i in range(5)]
+            downloader.fetch_many(urls, fns, workers=3, callback=done.append)
+            assert sorted(done) == sorted(fns)
+            for i, fn in enumerate(fns):
+                assert os.path.getsize(fn) == 3 * downloader.CHUNKSIZE // 2 + i
+            try:
+                downloader.fetch(f"{srv.url}/missing.pp", fns[0])
+                assert False
+            except IOError:
+                pass
+
+def test_downloader_resume():
+    import hashlib
+    from oceandata import downloader
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        srvdir = os.path.join(tmpdirname, "srv")
+        os.mkdir(srvdir)
+        data = os.urandom(300_000)
+        with open(os.path.join(srvdir, "GO_flux.tab"), "wb") as fH:
+            fH.write(data)
+        fn = os.path.join(tmpdirname, "GO_flux.tab")
+        with HTTPServer(srvdir) as srv:
+            url = f"{srv.url}/GO_flux.tab"
+            downloader.fetch(url, fn,
+                             checksum=hashlib.sha256(data).hexdigest())
+            etag = downloader.read_meta(fn)["etag"]
+            os.unlink(fn)
+            with open(fn + ".part", "wb") as fH:
+                fH.write(data[:100_000])
+            downloader.write_meta(fn + ".part", {"etag":etag})
+            downloader.fetch(url, fn)
+            assert srv.requests[-1]["Range"] == "bytes=100000-"
+            assert open(fn, "rb").read() == data
+            assert not os.path.isfile(fn + ".part")
+            downloader.fetch(url, fn)
+            assert srv.requests[-1]["If-None-Match"] == etag
+            assert open(fn, "rb").read() == data
+            try:
+                downloader.fetch(url, fn + "2", checksum="0" * 64)
+                assert False
+            except IOError:
+                assert not os.path.isfile(fn + "2")
+            os.unlink(fn)
+            with open(fn + ".part", "wb") as fH:
+                fH.write(data[:100_000])
+            downloader.write_meta(fn + ".part", {"etag":etag,
+                                                 "length":250_000})
+            with pytest.raises(IOError, match="Can not resume"):
+                downloader.fetch(url, fn)
+            assert not os.path.isfile(fn + ".part")
+            assert downloader.fetch(url, fn) == fn
+            assert open(fn, "rb").read() == data
+
+def test_downloader_stored_checksum(monkeypatch):
+    import types
+    from oceandata import downloader
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        srvdir = os.path.join(tmpdirname, "srv")
+        os.mkdir(srvdir)
+        with open(os.path.join(srvdir, "GO_flux.tab"), "wb") as fH:
+            fH.write(os.urandom(1000))
+        fn = os.path.join(tmpdirname, "GO_flux.tab")
+        with HTTPServer(srvdir) as srv:
+            url = f"{srv.url}/GO_flux.tab"
+            downloader.fetch(url, fn)
+            session = downloader.session()
+            def get(url, headers, **kwargs):
+                headers.pop("If-None-Match")
+                return session.get(url, headers=headers, **kwargs)
+            monkeypatch.setattr(downloader, "session",
+                                lambda: types.SimpleNamespace(get=get))
+            assert downloader.fetch(url, fn) == fn
+            meta = downloader.read_meta(fn)
+            downloader.write_meta(fn, dict(meta, sha256="0" * 64))
+            with pytest.raises(IOError, match="Checksum mismatch"):
+                downloader.fetch(url, fn)
+
+def write_hot_pp(filename, cruise=1, nrows=12):
+    with open(filename, "w") as fH:
+        for line in range(7):
+            fH.write(f"HOT primary production header line {line}\n")
+        for row in range(nrows):
+            date = pd.Timestamp("1989-01-01") + pd.Timedelta(days=31 * cruise)
+            values = ([cruise, row % 2, 1200, f"{date:%y%m%d}", 600, 1800,
+                       5 * row, 0.1, 0.01, 0.05, 0.01] +
+                      [3.0 + row, 3.2 + row, -9, 0.1, 0.2, 0.1] +
+                      [35.1, 100, 200, 300, 40, 0])
+            fH.write(" ".join(str(v) for v in values) + "\n")
+    return filename
+
+def write_listing(directory):
+    names = sorted(fn for fn in os.listdir(directory) if fn.endswith(".pp"))
+    with open(os.path.join(directory, "index.html"), "w") as fH:
+        fH.write("<html><body><pre>\n")
+        for name in names:
+            stat = os.stat(os.path.join(directory, name))
+            fH.write(f'<a href="{name}">{name}</a>   '
+                     f'{stat.st_mtime_ns} {stat.st_size}\n')
+        fH.write("</pre></body></html>\n")
+
+def test_hot_update(monkeypatch):
+    from oceandata.primary_production import hot
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        srvdir = os.path.join(tmpdirname, "srv")
+        os.mkdir(srvdir)
+        for cruise in range(1, 4):
+            write_hot_pp(os.path.join(srvdir, f"hot{cruise}.pp"), cruise)
+        write_listing(srvdir)
+        with HTTPServer(srvdir) as srv:
+            monkeypatch.setattr(hot, "DATAURL", srv.url)
+            assert sorted(hot.update()) == ["hot1.pp", "hot2.pp", "hot3.pp"]
+            df = hot.load()
+            assert len(df) == 36
+            assert (df.pp_obs > 0).all()
+            nreq = len(srv.requests)
+            assert hot.update() == []
+            assert len(srv.requests) == nreq + 1
+            write_hot_pp(os.path.join(srvdir, "hot2.pp"), 2, nrows=20)
+            write_hot_pp(os.path.join(srvdir, "hot4.pp"), 4)
+            write_listing(srvdir)
+            mtime = os.path.getmtime(hot.part_filename("hot1.pp"))
+            assert sorted(hot.update()) == ["hot2.pp", "hot4.pp"]
+            assert os.path.getmtime(hot.part_filename("hot1.pp")) == mtime
+            assert len(hot.load()) == 3 * 12 + 20
+            df = hot.load(start="1989-03-01", depth=20, columns=["pp_obs"])
+            assert list(df.columns) == ["pp_obs"] and len(df) == 2 * 5 + 5
+            assert len(hot.load(bbox=(0, 0, 10, 10))) == 0
+
+def test_hot_update_failed(monkeypatch):
+    from oceandata import downloader
+    from oceandata.primary_production import hot
+    fetch = downloader.fetch
+    def flaky(url, local_filename, **kwargs):
+        if url.endswith(("hot2.pp", "hot3.pp")):
+            return False
+        return fetch(url, local_filename, **kwargs)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        srvdir = os.path.join(tmpdirname, "srv")
+        os.mkdir(srvdir)
+        for cruise in range(1, 3):
+            write_hot_pp(os.path.join(srvdir, f"hot{cruise}.pp"), cruise)
+        write_listing(srvdir)
+        with HTTPServer(srvdir) as srv:
+            monkeypatch.setattr(hot, "DATAURL", srv.url)
+            assert sorted(hot.update()) == ["hot1.pp", "hot2.pp"]
+            write_hot_pp(os.path.join(srvdir, "hot2.pp"), 2, nrows=20)
+            write_hot_pp(os.path.join(srvdir, "hot3.pp"), 3)
+            write_listing(srvdir)
+            monkeypatch.setattr(downloader, "fetch", flaky)
+            assert hot.update() == []
+            assert sorted(hot.read_manifest()["files"]) == ["hot1.pp",
+                                                            "hot2.pp"]
+            assert len(hot.load()) == 24
+            monkeypatch.setattr(downloader, "fetch", fetch)
+            assert sorted(hot.update()) == ["hot2.pp", "hot3.pp"]
+            assert len(hot.load()) == 12 + 20 + 12
+
+def test_hot_legacy(monkeypatch):
+    from oceandata.primary_production import hot
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        srvdir = os.path.join(tmpdirname, "srv")
+        os.mkdir(srvdir)
+        for cruise in range(1, 3):
+            write_hot_pp(os.path.join(srvdir, f"hot{cruise}.pp"), cruise)
+        write_listing(srvdir)
+        with HTTPServer(srvdir) as srv:
+            monkeypatch.setattr(hot, "DATAURL", srv.url)
+            df = hot.load(os.path.join(tmpdirname, "pp"), depth=20)
+            assert os.path.isfile(os.path.join(tmpdirname, "pp", "parts",
+                                               "hot1.parquet"))
+            assert not os.path.exists(hot.DATADIR)
+            with pytest.warns(DeprecationWarning):
+                hot.generate_h5_file()
+        with pytest.warns(DeprecationWarning):
+            df2 = hot.load(filename="pp_hot.h5", depth=20)
+    pd.testing.assert_frame_equal(df2, df)
+
+def test_hot_read_pp_files():
+    from oceandata.primary_production import hot
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        fns = [write_hot_pp(os.path.join(tmpdirname, f"hot{i}.pp"), i, 5 + i)
+               for i in range(1, 6)]
+        df = hot.read_pp_files(*fns, source=True)
+        expected = pd.concat([hot.read_pp(fn) for fn in fns])
+    pd.testing.assert_frame_equal(df.drop(columns="source"), expected)
+    assert (df.groupby("source", observed=True).size().values ==
+            [6, 7, 8, 9, 10]).all()
+
+def test_oscillations():
+    from oceandata import oscillations
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        srvdir = os.path.join(tmpdirname, "srv")
+        os.mkdir(srvdir)
+        with open(os.path.join(srvdir, "test.data"), "w") as fH:
+            fH.write(" 2000 2001\n")
+            fH.write(" 2000" + 12 * "   0.50" + "\n")
+            fH.write(" 2001" + 6 * "  -1.00" + 6 * " -99.99" + "\n")
+            fH.write("  -99.99\n  Test index\n")
+        with HTTPServer(srvdir) as srv:
+            oscillations.register("test", f"{srv.url}/test.data")
+            df = oscillations.load("test")
+            assert len(srv.requests) == 1
+            df2 = oscillations.load("test")
+            assert len(srv.requests) == 1
+            oscillations.load("test", maxage=0)
+            assert srv.requests[-1]["If-None-Match"]
+        with pytest.warns(DeprecationWarning):
+            df3 = oscillations.read_psl(os.path.join(srvdir, "test.data"),
+                                        skipfooter=2)
+    pd.testing.assert_frame_equal(df, df2)
+    pd.testing.assert_frame_equal(df3.rename(columns={"value":"test"}), df)
+    assert len(df) == 24 and df.test.isna().sum() == 6
+    assert df.index[13] == pd.Timestamp("2001-02-01")
+    assert df.test.iloc[0] == 0.5
+
+def test_oscillations_offline(monkeypatch):
+    from oceandata import downloader, oscillations
+    monkeypatch.setattr(downloader, "fetch", lambda url, fn: False)
+    oscillations.register("test", "https://example.invalid/test.data")
+    with pytest.raises(IOError, match="Could not download index 'test'"):
+        oscillations.load("test")
+    os.makedirs(oscillations.DATADIR)
+    with open(os.path.join(oscillations.DATADIR, "test.data"), "w") as fH:
+        fH.write(" 2000 2000\n 2000" + 12 * "   0.50" + "\n  -99.99\n")
+    with pytest.warns(UserWarning, match="using local copy"):
+        df = oscillations.load("test", maxage=0)
+    assert len(df) == 12
+
+def test_oscillations_annotate(monkeypatch):
+    import numpy as np
+    from oceandata import oscillations
+    months = pd.date_range("2000-01-01", periods=24, freq="MS")
+    index = pd.DataFrame({"month":months.month, "test":np.arange(24.0)},
+                         index=months)
+    monkeypatch.setattr(oscillations, "load",
+                        lambda name, maxage=None: index.rename(
+                            columns={"test":name}))
+    df = pd.DataFrame({"lat":[1, 2, 3, 4], "lon":[1, 2, 3, 4]},
+                      index=pd.DatetimeIndex(["2000-01-15", "2001-12-31",
+                                              "2002-01-01", "1999-12-01"]))
+    df = oscillations.annotate(df, indices=["test"])
+    assert np.allclose(df.test.values, [0, 23, np.nan, np.nan],
+                       equal_nan=True)
+    df = oscillations.annotate(df, indices=["test"], lag=2, rolling=3)
+    assert np.allclose(df.test_lag2_mean3.values,
+                       [np.nan, 20, 21, np.nan], equal_nan=True)
+
+def test_matchup():
+    import numpy as np
+    from oceandata import matchup
+    gridlon = np.arange(-179.5, 180, 1.0)
+    gridlat = np.arange(89.5, -90, -1.0)
+    gridtime = pd.date_range("2003-01-01", periods=5, freq="D")
+    yy, xx = np.meshgrid(np.arange(180.0), np.arange(360.0), indexing="ij")
+    class Field:
+        ndim = 3
+        reads = 0
+        def __getitem__(self, key):
+            Field.reads += 1
+            t, ys, xs = key
+            return (t * 1000 + yy * 0 + xx)[ys, xs]
+    lon = np.array([-179.5, 10.5, 10.4, 200])
+    lat = np.array([0.5, -30.5, -30.5, 95])
+    time = pd.DatetimeIndex(["2003-01-02", "2003-01-02 06:00",
+                             "2003-01-04", "2003-01-02"])
+    vals = matchup.match(Field(), lon, lat, time, gridlon=gridlon,
+                         gridlat=gridlat, gridtime=gridtime)
+    assert Field.reads == 2
+    assert np.allclose(vals, [1000, 1190, 3190, np.nan], equal_nan=True)
+    vals = matchup.match(Field(), lon, lat, time, nei=3, gridlon=gridlon,
+                         gridlat=gridlat, gridtime=gridtime)
+    assert np.allclose(vals[:3], [1000 + (359 + 0 + 1) / 3, 1190, 3190])
+    vals = matchup.match(Field(), lon, lat, time + pd.Timedelta(days=9),
+                         maxdt="1D", gridlon=gridlon, gridlat=gridlat,
+                         gridtime=gridtime)
+    assert np.isnan(vals[:3]).all() and np.isnan(vals[3])
+
+def slow_reader(filename):
+    import time
+    import numpy as np
+    with open(filename + ".calls", "a") as fH:
+        fH.write("x")
+    time.sleep(0.5)
+    return pd.DataFrame({"a":np.arange(10)})
+
+def cached_worker(filename, cachedir):
+    from oceandata import cache
+    assert len(cache.cached("slow", filename, slow_reader,
+                            cachedir=cachedir)) == 10
+
+def test_store(store_root):
+    import sys
+    import zipfile
+    import subprocess
+    import multiprocessing
+    from oceandata import store
+    fn = store.path("source.txt")
+    with open(fn, "w") as fH:
+        fH.write("source")
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=cached_worker,
+                         args=(fn, store.path("cache")))
+             for _ in range(6)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert all(proc.exitcode == 0 for proc in procs)
+    assert open(fn + ".calls").read() == "x"
+    with store.lock("test"), store.lock("test"):
+        assert os.path.isfile(store.path("locks", "test.lock"))
+    with zipfile.ZipFile(store.path("a.zip"), "w") as zf:
+        zf.writestr("datasets/a.tab", "data")
+    store.extract(store.path("a.zip"), store_root)
+    assert open(store.path("datasets", "a.tab")).read() == "data"
+    assert os.listdir(store.path("datasets")) == ["a.tab"]
+    env = dict(os.environ, OCEANDATA_DIR=store_root,
+               PYTHONPATH=os.pathsep.join(sys.path))
+    out = subprocess.run([sys.executable, "-c",
+                          "from oceandata import gdp; print(gdp.DATADIR)"],
+                         env=env, capture_output=True, text=True,
+                         check=True)
+    assert out.stdout.strip() == store_root
+
+def test_bundle(monkeypatch):
+    import shutil
+    import tarfile
+    from click.testing import CliRunner
+    from oceandata import bundle, gdp, instrument, mapps, store
+    from oceandata.cli import cli
+    monkeypatch.setattr(store, "BUNDLE", None)
+    monkeypatch.setattr(mapps, "DATADIR", SAMPLEDIR)
+    shutil.copy(os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz"),
+                gdp.segment_filename(1))
+    pml = mapps.load_pml(bbox=(-80, 0, 20, 60), depth=50)
+    drifters = gdp.load(1, sst=True, start="2010-11-01")
+    fn = store.path("bundle.tar")
+    result = CliRunner().invoke(cli, ["bundle", "export", fn, "-d",
+                                      "mapps_pml", "-d", "buoydata_1"])
+    assert result.exit_code == 0, result.output
+    os.unlink(gdp.segment_filename(1))
+    shutil.rmtree(store.path("cache"))
+    monkeypatch.setattr(mapps, "DATADIR", store.path())
+    store.set_bundle(fn)
+    assert bundle.verify() == []
+    pd.testing.assert_frame_equal(
+        mapps.load_pml(bbox=(-80, 0, 20, 60), depth=50), pml)
+    pd.testing.assert_frame_equal(
+        gdp.load(1, sst=True, start="2010-11-01"), drifters)
+    store.set_bundle(None)
+    assert not bundle.has("mapps_pml")
+    result = CliRunner().invoke(cli, ["bundle", "import", fn])
+    assert result.exit_code == 0, result.output
+    assert bundle.location() == store.path("bundle")
+    pd.testing.assert_frame_equal(
+        mapps.load_pml(bbox=(-80, 0, 20, 60), depth=50), pml)
+    assert not os.path.isdir(store.path("cache"))
+    meta = bundle.manifest()
+    assert meta["datasets"]["mapps_pml"]["rows"] > len(pml)
+    with tarfile.open(fn) as tf:
+        offset = tf.getmember("data/buoydata_1.parquet").offset_data
+    with open(fn, "r+b") as fH:
+        fH.seek(offset + 100)
+        fH.write(b"x" * 100)
+    assert bundle.verify(fn) == ["buoydata_1"]
+    try:
+        bundle.install(fn)
+        assert False
+    except IOError:
+        pass
+    assert bundle.verify() == []
+    monkeypatch.setattr(mapps, "DATADIR", SAMPLEDIR)
+    with instrument.collect() as stats:
+        df = mapps.load_pml(filename=mapps.PMLFILENAME,
+                            bbox=(-80, 0, 20, 60), depth=50)
+    pd.testing.assert_frame_equal(df, pml)
+    assert "bundle_read" not in {event["stage"] for event in stats.events}
+
+def test_instrument(caplog):
+    import shutil
+    from oceandata import gdp, instrument
+    shutil.copy(os.path.join(SAMPLEDIR, "buoydata_sample.dat.gz"),
+                gdp.segment_filename(1))
+    with instrument.collect() as stats:
+        df = gdp.load(1, sst=True)
+    cold = {event["stage"]:event for event in stats.events}
+    assert set(cold) == {"hash", "read_csv", "datetime", "parse",
+                         "cache_write", "load"}
+    assert cold["read_csv"]["parent"] == "parse:buoydata_1"
+    assert cold["read_csv"]["rows"] == len(df)
+    assert cold["hash"]["bytes"] == os.path.getsize(gdp.segment_filename(1))
+    assert cold["load"]["duration"] >= cold["parse"]["duration"]
+    summary = stats.summary()
+    assert summary.loc["load", "rows"] == len(df)
+    assert summary.loc["cache_write", "mb_per_s"] > 0
+    instrument.enable_logging()
+    try:
+        with instrument.collect() as stats:
+            gdp.load(1, sst=True, start="2010-11-01")
+    finally:
+        instrument.disable_logging()
+    assert [event["stage"] for event in stats.events] == [
+        "cache_read", "load"]
+    assert "cache_read buoydata_1" in caplog.text
+    try:
+        with instrument.collect() as stats:
+            gdp.load(1, depth=10)
+        assert False
+    except KeyError:
+        pass
+    assert stats.events[-1]["error"] == "KeyError"
+    assert instrument._callbacks == []
+
+def test_set_root(monkeypatch):
+    import pathlib
+    from oceandata import cache, gdp, mapps, store
+    from oceandata.primary_production import hot, mattei
+    old = store.ROOT
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        monkeypatch.setattr(mapps, "DATADIR", SAMPLEDIR)
+        store.set_root(tmpdirname)
+        try:
+            assert gdp.DATADIR == tmpdirname
+            assert gdp.TRAJDIR == os.path.join(tmpdirname,
+                                               "buoydata_trajectories")
+            assert cache.CACHEDIR == os.path.join(tmpdirname, "cache")
+            assert hot.DATADIR == pathlib.PurePath(tmpdirname, "HOT", "pp")
+            assert mattei.DATADIR == pathlib.PurePath(tmpdirname)
+            assert mapps.DATADIR == SAMPLEDIR
+            df = mapps.load_pml()
+            assert os.listdir(cache.CACHEDIR)
+        finally:
+            store.set_root(old)
+    assert cache.CACHEDIR == os.path.join(old, "cache")
+    assert len(df) > 0
+
+def test_lazy_submodules():
+    import sys
+    import subprocess
+    code = ("import oceandata\n"
+            "for name in oceandata._submodules:\n"
+            "    getattr(oceandata, name)\n"
+            "for pkg in ['chl', 'rrs', 'primary_production', "
+            "'export_production']:\n"
+            "    mod = getattr(oceandata, pkg)\n"
+            "    for name in getattr(mod, 'SUBMODULES', ['valente']):\n"
+            "        assert name in dir(mod)\n"
+            "        getattr(mod, name)\n"
+            "print(oceandata.rrs.valente.__name__, "
+            "oceandata.chl.load_valente.__module__)")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        env = dict(os.environ, HOME=tmpdirname,
+                   PYTHONPATH=os.pathsep.join(sys.path))
+        out = subprocess.run([sys.executable, "-c", code], env=env,
+                             capture_output=True, text=True, check=True)
+    assert out.stdout.split() == ["oceandata.rrs.valente",
+                                  "oceandata.chl.valente"]
+
+def test_lazy_import():
+    import sys
+    import subprocess
+    code = ("import sys, oceandata; from oceandata import gdp, mapps; "
+            "from oceandata.primary_production import hot; "
+            "print(sorted(m for m in ['requests', 'click', 'bs4'] "
+            "if m in sys.modules))")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        env = dict(os.environ, HOME=tmpdirname,
+                   PYTHONPATH=os.pathsep.join(sys.path))
+        out = subprocess.run([sys.executable, "-c", code], env=env,
+                             capture_output=True, text=True, check=True)
+        assert out.stdout.strip() == "[]"
+        assert os.listdir(tmpdirname) == []